@@ -0,0 +1,140 @@
+"""
+computes candles of any resolution from the stored trades at once, without a loop per trade
+for rebuilding the candles of a resolution or for checking the ones built trade by trade
+usage: python batch_candles.py <exchange> <market> <resolution> <start> <end> [check|rebuild]
+e.g.:  python batch_candles.py Ftx BTC-PERP 300 2021-12-01 2022-01-01 check  # end exclusive
+"""
+import sys
+
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import numpy as np
+from sqlalchemy import select
+
+from db import Candle, Trade, to_epoch_us, US_PER_SECOND
+from storage import storage
+
+ATTRS = ["open", "close", "high", "low", "volume"]
+
+
+def load_trades(session, exchange: str, market: str, start: int,
+                end: int) -> Dict[str, np.ndarray]:
+    """trades in [start, end), Unix microseconds, in the order received; a single range query"""
+    rows = session.execute(
+        select(Trade.time, Trade.price, Trade.size).where(
+            Trade.exchange_name == exchange,
+            Trade.market == market,
+            Trade.time >= start,
+            Trade.time < end,
+        ).order_by(Trade.time, Trade.id)
+    ).all()
+    trades = np.array(rows, dtype=np.int64).reshape(-1, 3)
+    return {"time": trades[:, 0], "price": trades[:, 1], "size": trades[:, 2]}
+
+
+def align_range(resolution: int, start: int, end: int) -> Tuple[int, int]:
+    """
+    [start, end) narrowed to whole periods of the resolution, e.g. to whole weeks of a week long
+    resolution, which starts on a Thursday (the epoch) and not at the given dates
+    """
+    resolution_us = resolution * US_PER_SECOND
+    return start + (-start) % resolution_us, end - end % resolution_us
+
+
+def compute_candles(trades: Dict[str, np.ndarray], resolution: int, start: int,
+                    end: int) -> Dict[str, np.ndarray]:
+    """
+    OHLCV of the periods in [start, end) with trades, like the ones built trade by trade
+    trades: time ordered columns, e.g. from load_trades or tape.read_trades; in ticks and lots
+    periods are aligned to the Unix epoch, i.e. to the midnight if they divide a day
+    start, end are expected on period boundaries, see align_range
+    """
+    time, price, size = trades["time"], trades["price"], trades["size"]
+    resolution_us = resolution * US_PER_SECOND
+    edges = np.arange(start - start % resolution_us, end + resolution_us, resolution_us)
+    bounds = np.searchsorted(time, edges, side="left")  # first trade of each period
+    non_empty = bounds[:-1] < bounds[1:]
+    firsts, lasts = bounds[:-1][non_empty], bounds[1:][non_empty] - 1
+
+    return {
+        "start_time": edges[:-1][non_empty],
+        "open":       price[firsts],
+        "close":      price[lasts],
+        "high":       np.maximum.reduceat(price, firsts) if len(firsts) else price[:0],
+        "low":        np.minimum.reduceat(price, firsts) if len(firsts) else price[:0],
+        "volume":     np.add.reduceat(price * size, firsts) if len(firsts) else price[:0],
+    }
+
+
+def get_stored_candles(session, exchange: str, market: str, resolution: int, start: int,
+                       end: int) -> Dict[int, Candle]:
+    return {candle.start_time: candle for candle in session.query(Candle).filter(
+        Candle.exchange_name == exchange,
+        Candle.market == market,
+        Candle.resolution == resolution,
+        Candle.start_time >= start,
+        Candle.start_time < end,
+    )}
+
+
+def check_candles(session, candles: Dict[str, np.ndarray], exchange: str, market: str,
+                  resolution: int, start: int, end: int) -> List[tuple]:
+    """(start_time, attr, stored, computed) of each difference with the stored candles"""
+    stored = get_stored_candles(session, exchange, market, resolution, start, end)
+    discrepancies = []
+    for i, start_time in enumerate(candles["start_time"].tolist()):
+        candle = stored.pop(start_time, None)
+        for attr in ATTRS:
+            computed = int(candles[attr][i])
+            value = getattr(candle, attr) if candle else None
+            if value != computed:
+                discrepancies.append((start_time, attr, value, computed))
+    for start_time, candle in stored.items():  # stored, but no trades
+        discrepancies.extend((start_time, attr, getattr(candle, attr), None) for attr in ATTRS)
+    return sorted(discrepancies)
+
+
+def rebuild_candles(session, candles: Dict[str, np.ndarray], exchange: str, market: str,
+                    resolution: int, start: int, end: int) -> None:
+    """replaces the stored candles of the resolution in [start, end) with the computed ones"""
+    session.query(Candle).filter(
+        Candle.exchange_name == exchange,
+        Candle.market == market,
+        Candle.resolution == resolution,
+        Candle.start_time >= start,
+        Candle.start_time < end,
+    ).delete(synchronize_session=False)
+    columns = {attr: values.tolist() for attr, values in candles.items()}
+    session.bulk_insert_mappings(Candle, [
+        {"exchange_name": exchange, "market": market, "resolution": resolution,
+         **{attr: values[i] for attr, values in columns.items()}}
+        for i in range(len(columns["start_time"]))
+    ])
+    session.commit()
+
+
+if __name__ == "__main__":
+    exchange, market, resolution = sys.argv[1], sys.argv[2], int(sys.argv[3])
+    start = to_epoch_us(datetime.strptime(sys.argv[4], "%Y-%m-%d"))
+    end = to_epoch_us(datetime.strptime(sys.argv[5], "%Y-%m-%d"))
+    command = sys.argv[6] if len(sys.argv) > 6 else "check"
+    start, end = align_range(resolution, start, end)  # no partial candle at either end
+    if start >= end:
+        sys.exit("No whole period of the resolution in the given range.")
+
+    session = storage.writer_session() if command == "rebuild" else storage.reader_session()
+    trades = load_trades(session, exchange, market, start, end)
+    candles = compute_candles(trades, resolution, start, end)
+    print(f"Computed {len(candles['start_time'])} candles from {len(trades['time'])} trades.")
+
+    if command == "rebuild":
+        rebuild_candles(session, candles, exchange, market, resolution, start, end)
+        print("Replaced the stored candles.")
+    else:
+        discrepancies = check_candles(session, candles, exchange, market, resolution, start, end)
+        for start_time, attr, stored, computed in discrepancies:
+            print(f"DISCREPANCY FOUND FOR {attr.ljust(7)} of the candle starting at {start_time}:"
+                  f" stored {stored} vs computed {computed}")
+        if not discrepancies:
+            print("Cool! No discrepancy found.")
@@ -0,0 +1,260 @@
+import json
+import queue
+
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+from db import Candle, Market, now_epoch_us, from_units
+from storage import storage
+
+Key = Tuple[str, str, int]  # exchange, market, resolution
+
+KEEPALIVE_SECONDS = 15  # a comment line is sent to the idle streams to detect disconnects
+
+
+def candle_to_dict(candle: Candle, closed: bool) -> dict:
+    """a snapshot of the candle, safe to be read on other threads than the one updating it"""
+    return {
+        "exchange":   candle.exchange_name,
+        "market":     candle.market,
+        "resolution": candle.resolution,
+        "start_time": candle.start_time,
+        "open":       candle.open,
+        "close":      candle.close,
+        "high":       candle.high,
+        "low":        candle.low,
+        "volume":     candle.volume,
+        "closed":     closed,
+    }
+
+
+class CandleCache:
+    """
+    keeps the most recent candles of each (exchange, market, resolution) in fixed-size ring buffers
+    ordered by start time, including the open candle that is still updating (the last one)
+    written by the queue consumer, read by the candle service; older candles are read from the db
+    """
+
+    def __init__(self, size: int, session_factory=None) -> None:
+        self.size = size
+        self.session_factory = session_factory or storage.reader_session  # not to block ingest
+        self._buffers: Dict[Key, Deque[dict]] = {}
+        # (exchange, market) => (price increment, size increment); candles are in ticks and lots
+        self.increments: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self._subscribers: List[Tuple[dict, queue.Queue]] = []
+        self._watermarks: Dict[Tuple[str, str], dict] = {}  # (exchange, market) => see below
+        self._lock = Lock()
+
+    def put(self, candle: Candle, closed: bool = False) -> None:
+        """
+        adds or updates the candle; closed is sticky, i.e. once closed a candle stays closed
+        subscribers are notified when the candle closes and each time a closed one is corrected
+        """
+        key = (candle.exchange_name, candle.market, candle.resolution)
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                buffer = self._buffers[key] = deque([], maxlen=self.size)
+
+            if buffer and buffer[-1]["start_time"] == candle.start_time:  # the usual; open one
+                index = len(buffer) - 1
+            elif not buffer or buffer[-1]["start_time"] < candle.start_time:  # a new one
+                index = None
+            elif buffer[0]["start_time"] > candle.start_time:
+                return  # older than the buffer, only in the db
+            else:  # a late update
+                index = bisect_left([c["start_time"] for c in buffer], candle.start_time)
+
+            if index is not None and buffer[index]["start_time"] == candle.start_time:
+                snapshot = candle_to_dict(candle, closed or buffer[index]["closed"])
+                buffer[index] = snapshot
+            else:
+                snapshot = candle_to_dict(candle, closed)
+                if index is None:
+                    buffer.append(snapshot)
+                else:
+                    if len(buffer) == buffer.maxlen:
+                        buffer.popleft()
+                        index -= 1
+                    buffer.insert(index, snapshot)
+
+            if closed:
+                for filters, subscriber in self._subscribers:
+                    if all(snapshot[attr] == value for attr, value in filters.items()):
+                        subscriber.put(snapshot)
+
+    def get_candles(self, exchange: str, market: str, resolution: int, start: int = None,
+                    end: int = None, limit: int = None) -> List[dict]:
+        """
+        candles starting in [start, end) in order; the last `limit` of them if given
+        served from the ring buffer, falls back to the db only for the part older than the buffer
+        without start, limit defaults to the size of the buffer: not the whole history at once
+        """
+        if start is None and limit is None:
+            limit = self.size
+        start = float("-inf") if start is None else start
+        end = float("+inf") if end is None else end
+        with self._lock:
+            buffer = self._buffers.get((exchange, market, resolution), ())
+            cached = [c for c in buffer if start <= c["start_time"] < end]
+            first_cached = buffer[0]["start_time"] if buffer else float("+inf")
+
+        if start >= first_cached or (limit and len(cached) >= limit):
+            older = []
+        else:
+            older = self._load_candles(
+                exchange, market, resolution, start, min(end, first_cached),
+                limit - len(cached) if limit else None)
+
+        candles = older + cached
+        return candles[-limit:] if limit else candles
+
+    def _load_candles(self, exchange: str, market: str, resolution: int, start: float,
+                      end: float, limit: Optional[int]) -> List[dict]:
+        """reads the candles from the db, most recent `limit` of them"""
+        session = self.session_factory()
+        try:
+            query = session.query(Candle).filter(
+                Candle.exchange_name == exchange,
+                Candle.market == market,
+                Candle.resolution == resolution,
+                Candle.start_time >= start,
+                Candle.start_time < end,
+            ).order_by(Candle.start_time.desc())
+            if limit:
+                query = query.limit(limit)
+            now = now_epoch_us()
+            return [candle_to_dict(c, c.end_time <= now)
+                    for c in reversed(query.all())]
+        finally:
+            session.close()
+
+    def to_prices(self, candle: dict) -> dict:
+        """converts the candle in ticks to prices, and its volume in ticks * lots to the quote"""
+        key = (candle["exchange"], candle["market"])
+        if key not in self.increments:  # not subscribed to in this run
+            session = self.session_factory()
+            try:
+                market = session.query(Market).filter_by(
+                    exchange_name=candle["exchange"], name=candle["market"]).one()
+                self.increments[key] = (market.price_increment, market.size_increment)
+            finally:
+                session.close()
+        price_increment, size_increment = self.increments[key]
+
+        candle = dict(candle)
+        for attr in ["open", "close", "high", "low"]:
+            candle[attr] = from_units(candle[attr], price_increment)
+        candle["volume"] = from_units(candle["volume"], price_increment * size_increment)
+        return candle
+
+    def set_watermark(self, exchange: str, market: str, watermark: Optional[int],
+                      late_trades: int) -> None:
+        """the event time up to which the candles of the market are final, see main.py"""
+        with self._lock:
+            self._watermarks[(exchange, market)] = {
+                "exchange": exchange, "market": market, "watermark": watermark,
+                "late_trades": late_trades}
+
+    def get_watermarks(self) -> List[dict]:
+        with self._lock:
+            return [dict(watermark) for watermark in self._watermarks.values()]
+
+    def subscribe(self, **filters) -> queue.Queue:
+        """returns a queue that closed candles matching the filters, e.g. market=.., are put in"""
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers.append((filters, subscriber))
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue) -> None:
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s[1] is not subscriber]
+
+
+class CandleRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /candles?exchange=Ftx&market=BTC-PERP&resolution=60&start=..&end=..&limit=..
+        start, end are Unix times in microseconds and optional, so is limit
+        without start, limit defaults to CANDLE_CACHE_SIZE
+        prices are converted back from the ticks, i.e. as floats
+    GET /candles/stream?exchange=Ftx&market=BTC-PERP&resolution=60
+        server-sent events, one per closed candle; all the filters are optional
+    GET /watermarks
+        per market, the trade time (Unix microsecs) up to which the candles are final, and the
+        number of the trades that came after their candle was final, i.e. not in the candles
+    """
+    cache: CandleCache = None  # set by serve_candles
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == "/candles":
+                self._send_candles(params)
+            elif url.path == "/candles/stream":
+                self._stream_candles(params)
+            elif url.path == "/watermarks":
+                self._send_json(200, self.cache.get_watermarks())
+            else:
+                self._send_json(404, {"error": f"Unknown path {url.path}"})
+        except (KeyError, ValueError) as error:
+            self._send_json(400, {"error": f"Bad parameter: {error}"})
+
+    def _send_candles(self, params: dict) -> None:
+        candles = self.cache.get_candles(
+            exchange=params["exchange"],
+            market=params["market"],
+            resolution=int(params["resolution"]),
+            start=int(params["start"]) if "start" in params else None,
+            end=int(params["end"]) if "end" in params else None,
+            limit=int(params["limit"]) if "limit" in params else None,
+        )
+        self._send_json(200, [self.cache.to_prices(candle) for candle in candles])
+
+    def _stream_candles(self, params: dict) -> None:
+        filters = {attr: params[attr] for attr in ("exchange", "market") if attr in params}
+        if "resolution" in params:
+            filters["resolution"] = int(params["resolution"])
+
+        subscriber = self.cache.subscribe(**filters)
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            while True:
+                try:
+                    candle = self.cache.to_prices(subscriber.get(timeout=KEEPALIVE_SECONDS))
+                    self.wfile.write(f"event: close\ndata: {json.dumps(candle)}\n\n".encode())
+                except queue.Empty:
+                    self.wfile.write(b": keepalive\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client is gone
+        finally:
+            self.cache.unsubscribe(subscriber)
+
+    def _send_json(self, status: int, body) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args) -> None:
+        pass  # too noisy next to the trades
+
+
+def serve_candles(cache: CandleCache, port: int, host: str = "127.0.0.1") -> None:
+    """serves the candles locally, forever; run it on its own thread"""
+    handler = type("BoundCandleRequestHandler", (CandleRequestHandler,), {"cache": cache})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    print(f"Serving candles at http://{host}:{port}/candles")
+    server.serve_forever()
@@ -1,18 +1,47 @@
-import os
+import time as time_module
 
-from sqlalchemy import create_engine, ForeignKey, UniqueConstraint, DateTime
-from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy import Column, Integer, String, Boolean, Float
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 
-Base = declarative_base()
+from sqlalchemy import ForeignKey, UniqueConstraint, Index, DateTime
+from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, Float
 
-SQL_FILE_NAME = os.getenv("SQL_FILE_NAME")
-engine = create_engine(f'sqlite:///{SQL_FILE_NAME}', connect_args={'check_same_thread': False})
+Base = declarative_base()  # the engines are in storage.py
 
+SCHEMA_VERSION = 3  # kept in `PRAGMA user_version`; see migrate.py for upgrading older dbs
+# 1: times in float seconds, 2: times in integer microseconds, 3: prices, sizes in ticks, lots
 
-# todo: convert start_time, time fields below to DateTime column after switching to a
-#  full fledged db. SqLite seems to not handle well:
+# start_time, time fields below are integer Unix times in microseconds, so that they are matched
+# exactly; SqLite does not handle DateTime well:
 #  https://docs.sqlalchemy.org/en/14/core/type_basics.html#sqlalchemy.types.DateTime
+US_PER_SECOND = 1_000_000
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_epoch_us(time: datetime) -> int:
+    """exact Unix time in microseconds, unlike time.timestamp(); naive times are taken as UTC"""
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return (time - EPOCH) // timedelta(microseconds=1)
+
+
+def now_epoch_us() -> int:
+    return time_module.time_ns() // 1_000
+
+
+# prices are integer ticks and sizes integer lots of the market, i.e. multiples of its
+# priceIncrement and sizeIncrement; volumes are in ticks * lots. Exact, unlike floats.
+def to_units(value: float, increment: float) -> int:
+    """converted once, at ingest; e.g. price 48123.5 with increment 0.5 => 96247 ticks"""
+    return round(value / increment)
+
+
+def from_units(units: int, increment: float) -> float:
+    """e.g. 96247 ticks with increment 0.5 => 48123.5; rounded to the decimals of the increment"""
+    decimals = max(0, -Decimal(repr(increment)).normalize().as_tuple().exponent)
+    return round(units * increment, decimals)
+
 
 class Exchange(Base):
     # params: market_name, start_time, end_time
@@ -22,6 +51,30 @@ class Exchange(Base):
     name = Column(String, primary_key=True)
     trades = relationship("Trade", back_populates="exchange")
     candles = relationship("Candle", back_populates="exchange")
+    open_interests = relationship("OpenInterest", back_populates="exchange")
+    markets = relationship("Market", back_populates="exchange")
+
+
+class Market(Base):  # for converting prices and sizes to ticks and lots, and back
+    # params: (none), all markets in one call
+
+    __tablename__ = "market"
+
+    id = Column(Integer, primary_key=True)
+    exchange_name = Column(String, ForeignKey("exchange.name"))
+    exchange = relationship("Exchange", back_populates="markets")
+    name = Column(String, nullable=False)
+    price_increment = Column(Float, nullable=False)  # a tick
+    size_increment = Column(Float, nullable=False)  # a lot
+
+    def __str__(self):
+        return f"Market (id={self.id}, exchange_name={self.exchange_name}, name={self.name}," \
+               f" price_increment={self.price_increment}," \
+               f" size_increment={self.size_increment}, )"
+
+    __table_args__ = (
+        UniqueConstraint('exchange_name', 'name', name='exch_name_uc'),
+    )
 
 
 class Trade(Base):
@@ -33,16 +86,20 @@ class Trade(Base):
     exchange_name = Column(String, ForeignKey("exchange.name"))
     exchange = relationship("Exchange", back_populates="trades")
     market = Column(String, nullable=False)
-    price = Column(Float, nullable=False)
+    price = Column(BigInteger, nullable=False)  # in ticks
     side = Column(String, nullable=False)
-    size = Column(Float, nullable=False)
-    time = Column(Float, nullable=False)  # Unix time in seconds
+    size = Column(BigInteger, nullable=False)  # in lots
+    time = Column(BigInteger, nullable=False)  # Unix time in microseconds
     liquidation = Column(Boolean, nullable=False)
 
     def __str__(self):
         return f"Trade (id={self.id}, exchange_name={self.exchange_name}, market={self.market}," \
                f" price={self.price}, time={self.time}, side={self.side}, size={self.size}, )"
 
+    __table_args__ = (  # for get_or_create and range queries of a market
+        Index('trade_exch_market_time_idx', 'exchange_name', 'market', 'time'),
+    )
+
 
 class Candle(Base):  # historical prices
     # params: market_name, start_time, end_time, # params: market_name, start_time, end_time
@@ -55,12 +112,13 @@ class Candle(Base):  # historical prices
     market = Column(String, nullable=False)
     resolution = Column(Integer, nullable=False)  # window length in seconds.
     # in secs: 15, 60*, 300, 900, 3600*, 14400, 86400*, or any multiple of 86400 up to 30*86400
-    start_time = Column(Float, nullable=False)  # start time of the window/Unix time in seconds
-    open = Column(Float, nullable=False)  # mark price at start_time
-    close = Column(Float, nullable=False)  # mark price at the end of the window: start_time + resl.
-    high = Column(Float, default=float('-inf'), nullable=False)  # highest price over the window
-    low = Column(Float, default=float('+inf'), nullable=False)  # lowest price over the window
-    volume = Column(Float, default=0, nullable=False)  # volume traded in the window
+    start_time = Column(BigInteger, nullable=False)  # start of the window/Unix time in microsecs
+    # prices in ticks, volume in ticks * lots
+    open = Column(BigInteger, nullable=False)  # mark price at start_time
+    close = Column(BigInteger, nullable=False)  # mark price at the end of the window: start + resl.
+    high = Column(BigInteger, nullable=False)  # highest price over the window
+    low = Column(BigInteger, nullable=False)  # lowest price over the window
+    volume = Column(BigInteger, default=0, nullable=False)  # volume traded in the window
 
     def __str__(self):
         return f"Candle (id={self.id}, exchange_name={self.exchange_name}, market={self.market}," \
@@ -68,6 +126,10 @@ class Candle(Base):  # historical prices
                f" volume={self.volume}," \
                f" resolution={self.resolution}, start_time={self.start_time}, )"
 
+    @property
+    def end_time(self) -> int:
+        return self.start_time + self.resolution * US_PER_SECOND
+
     __table_args__ = (
         UniqueConstraint(
             'exchange_name', 'market', 'resolution', 'start_time',
@@ -75,6 +137,30 @@ class Candle(Base):  # historical prices
     )
 
 
+class OpenInterest(Base):  # futures stats at the close of each interval
+    # params: (none), all futures in one call
+
+    __tablename__ = "open_interest"
+
+    id = Column(Integer, primary_key=True)
+    exchange_name = Column(String, ForeignKey("exchange.name"))
+    exchange = relationship("Exchange", back_populates="open_interests")
+    market = Column(String, nullable=False)
+    time = Column(BigInteger, nullable=False)  # close time of the interval/Unix time in microsecs
+    open_interest = Column(Float, nullable=False)  # in the underlying, e.g. BTC for BTC-PERP
+    mark_price = Column(Float, nullable=False)
+    index_price = Column(Float, nullable=False)
+
+    def __str__(self):
+        return f"OpenInterest (id={self.id}, exchange_name={self.exchange_name}," \
+               f" market={self.market}, time={self.time}, open_interest={self.open_interest}," \
+               f" mark_price={self.mark_price}, index_price={self.index_price}, )"
+
+    __table_args__ = (
+        UniqueConstraint('exchange_name', 'market', 'time', name='exch_market_time_uc'),
+    )
+
+
 def get_or_create(session, model, commit=False, update=None, **kwargs):
     """return instance, created"""
     instance = session.query(model).filter_by(**kwargs).first()
@@ -93,11 +179,5 @@ def get_or_create(session, model, commit=False, update=None, **kwargs):
 
 
 if __name__ == "__main__":
-    try:
-        os.remove(SQL_FILE_NAME)
-        print(f"Removed file {SQL_FILE_NAME}.")
-    except OSError:
-        pass  # file did not exist
-
-    print(f"Created db: {SQL_FILE_NAME}.")
-    Base.metadata.create_all(engine)
+    from storage import storage  # not at the top, storage.py imports this module
+    storage.reset()
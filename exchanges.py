@@ -1,6 +1,14 @@
+import os
+
 from ftx.rest.client import FtxClient as FtxRestClient
-from ftx.websocket.client import FtxWebsocketClient
+from ftx.websocket.client import FtxWebsocketClient, TradesFrame, msgspec
 from datetime import datetime
+from ciso8601 import parse_datetime
+
+from db import to_epoch_us, to_units
+
+# connections kept open per exchange; the timers pulling candles and open interest may overlap
+REST_POOL_SIZE = int(os.getenv("REST_POOL_SIZE", "10"))
 
 
 class FtxRestClientExtended(FtxRestClient):
@@ -15,24 +23,39 @@ class FtxWebsocketClientExtended(FtxWebsocketClient):
         self.queue = queue
         self.name = name
         self.trade_count = 0
-        super().__init__()
+        self.increments = {}  # market => (price increment, size increment), see Ftx.load_increments
+        # records only pay off decoded by msgspec; without it they'd be built from the dicts
+        super().__init__(compact_trades=msgspec is not None)
+
+    def _handle_trade_records(self, frame: TradesFrame) -> None:
+        """receive the trades, decoded into records, and put them in the queue"""
+        self._put_trades(frame.market, (
+            (record.liquidation, record.price, record.side, record.size, record.time)
+            for record in frame.data
+        ))
 
     def _handle_trades_message(self, message: dict) -> None:
-        """receive the trade and put it in the queue"""
+        """receive the trades, decoded into dicts, and put them in the queue"""
+        self._put_trades(message["market"], (
+            (data["liquidation"], data["price"], data["side"], data["size"], data["time"])
+            for data in message["data"]
+        ))
+
+    def _put_trades(self, market: str, trades) -> None:
+        """trades: (liquidation, price, side, size, time) tuples"""
         self.trade_count += 1
+        price_increment, size_increment = self.increments[market]
 
-        for data in message["data"]:
-            time = datetime.strptime(data["time"], "%Y-%m-%dT%H:%M:%S.%f%z")
-            # example: 2021-12-09T13:49:39.407690+00:00
+        for liquidation, price, side, size, time in trades:
             self.queue.put({
                 "type":        "trade",
                 "exchange":    self.name,
-                "market":      message['market'],
-                "liquidation": data["liquidation"],
-                "price":       data["price"],
-                "side":        data["side"],
-                "size":        data["size"],
-                "time":        time,
+                "market":      market,
+                "liquidation": liquidation,
+                "price":       to_units(price, price_increment),  # in ticks
+                "side":        side,
+                "size":        to_units(size, size_increment),  # in lots
+                "time":        parse_datetime(time),  # example: 2021-12-09T13:49:39.407690+00:00
                 "number":      self.trade_count,
             })
 
@@ -44,7 +67,21 @@ class Ftx:
         self.name = "Ftx"
 
         self.websocket = FtxWebsocketClientExtended(queue, self.name)
-        self.rest = FtxRestClientExtended()
+        self.rest = FtxRestClientExtended(pool_size=REST_POOL_SIZE)
+        self.increments = {}  # market => (price increment, size increment)
+
+    def load_increments(self) -> None:
+        """
+        get the price and size increments of the markets, with a single call for all of them
+        prices and sizes are converted to integer ticks and lots with them at ingest
+        """
+        markets = {market["name"]: market for market in self.rest.list_markets()}
+        for market in self.markets:
+            if market not in markets:
+                raise ValueError(f"Market {market} is not listed on {self.name}!")
+            self.increments[market] = (
+                markets[market]["priceIncrement"], markets[market]["sizeIncrement"])
+        self.websocket.increments = self.increments
 
     def subscribe_to_trades(self) -> None:
         """subscribe to markets"""
@@ -56,18 +93,23 @@ class Ftx:
     def get_candle(self, resolution: int, start_time: float):
         """get candles for all markets for the given period and put them in the queue"""
         time_stamp = start_time.timestamp()
+        start_time_us = to_epoch_us(start_time)
         for market in self.markets:
             candles = self.rest.get_candles(market, resolution, time_stamp)
             # yeah, sometimes more than 1
+            price_increment, size_increment = self.increments[market]
 
             count = 0
             for candle in candles:
-                candle["time"] = candle["time"] / 1000  # comes in milliseconds
-                if candle["time"] == time_stamp:
+                candle["time"] = int(candle["time"]) * 1000  # comes in milliseconds
+                if candle["time"] == start_time_us:
                     candle["market"] = market
                     candle["resolution"] = resolution
                     candle["exchange"] = self.name
                     candle["type"] = "candle"
+                    for attr in ["open", "close", "high", "low"]:
+                        candle[attr] = to_units(candle[attr], price_increment)  # in ticks
+                    candle["volume"] = to_units(candle["volume"], price_increment * size_increment)
                     self.queue.put(candle)
                     count += 1
 
@@ -78,3 +120,30 @@ class Ftx:
                 print(f"start_time: {start_time}, time_stamp: {time_stamp}")
                 print(f"resolution {resolution}")
                 print("*" * 100, "candle pulled")
+
+    def get_open_interest(self, time: datetime) -> None:
+        """
+        get open interest, mark and index prices of all markets at the close of the interval
+        and put them in the queue; a single call for all the markets regardless of their number
+        """
+        futures = {future["name"]: future for future in self.rest.list_futures()}
+
+        rows = []
+        for market in self.markets:
+            future = futures.get(market)
+            if future is None:
+                print(f"No open interest for market {market}, it is not a future!")
+                continue
+            rows.append({
+                "market":        market,
+                "open_interest": future["openInterest"],
+                "mark_price":    future["mark"],
+                "index_price":   future["index"],
+            })
+
+        self.queue.put({
+            "type":     "open_interest",
+            "exchange": self.name,
+            "time":     to_epoch_us(time),
+            "futures":  rows,
+        })
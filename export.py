@@ -0,0 +1,138 @@
+"""
+exports trades or candles from the db, streaming; memory use is the same for any size
+parquet and arrow need pyarrow (`pipenv install pyarrow`), csv does not
+usage: python export.py trades|candles <file> [--format parquet|arrow|csv] [--exchange Ftx]
+           [--market BTC-PERP] [--start 2021-12-01] [--end 2022-01-01] [--resolution 60]
+values are as stored: times in Unix microseconds, prices in ticks, sizes in lots (see `market`)
+"""
+import argparse
+import csv
+import json
+
+from datetime import datetime
+from typing import Iterator, List
+
+from sqlalchemy import select
+
+from db import Candle, Market, Trade, to_epoch_us
+from storage import storage
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # csv only
+    pa = pq = None
+
+ROW_GROUP_SIZE = 100_000  # rows; also the number of rows fetched at once
+
+TABLES = {"trades": Trade, "candles": Candle}
+
+
+def get_columns(model) -> List[str]:
+    return [column.name for column in model.__table__.columns]
+
+
+def get_arrow_schema(model):
+    types = {"BIGINT": pa.int64(), "INTEGER": pa.int64(), "VARCHAR": pa.string(),
+             "BOOLEAN": pa.bool_(), "FLOAT": pa.float64()}
+    return pa.schema([(column.name, types[str(column.type)])
+                      for column in model.__table__.columns])
+
+
+def stream_rows(model, exchange: str = None, market: str = None, start: int = None,
+                end: int = None, resolution: int = None,
+                chunk_size: int = ROW_GROUP_SIZE) -> Iterator[list]:
+    """
+    rows in chunks, fetched from a server-side cursor; not sorted, as a sort would hold all of them
+    i.e. in the order of the scan: by market and time when filtered by exchange, by id otherwise
+    """
+    time_column = model.start_time if model is Candle else model.time
+    query = select(*model.__table__.columns)
+    if exchange:
+        query = query.where(model.exchange_name == exchange)
+    if market:
+        query = query.where(model.market == market)
+    if start is not None:
+        query = query.where(time_column >= start)
+    if end is not None:
+        query = query.where(time_column < end)
+    if resolution:
+        query = query.where(model.resolution == resolution)
+
+    with storage.reader_engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+
+def get_increments() -> str:
+    """of all the markets, to convert the ticks and lots back; kept in the file's metadata"""
+    with storage.reader_engine.connect() as connection:
+        markets = connection.execute(select(Market.exchange_name, Market.name,
+                                            Market.price_increment, Market.size_increment))
+        return json.dumps([dict(market._mapping) for market in markets])
+
+
+def export(table: str, path: str, file_format: str = "parquet", **filters) -> int:
+    """returns the number of rows written"""
+    model = TABLES[table]
+    columns = get_columns(model)
+    count = 0
+
+    if file_format == "csv":
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(columns)
+            for rows in stream_rows(model, **filters):
+                writer.writerows(rows)
+                count += len(rows)
+        return count
+
+    if pa is None:
+        raise ImportError(f"pyarrow is needed for {file_format}, export to csv instead!")
+    schema = get_arrow_schema(model).with_metadata({"markets": get_increments()})
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    try:
+        for rows in stream_rows(model, **filters):  # a row group, or a record batch, per chunk
+            batch = pa.RecordBatch.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+                schema=schema)
+            if file_format == "parquet":
+                writer.write_table(pa.Table.from_batches([batch]), row_group_size=len(rows))
+            else:
+                writer.write_batch(batch)
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+
+def parse_time(value: str) -> int:
+    """e.g. 2021-12-01 or 2021-12-01T10:30, in UTC"""
+    return to_epoch_us(datetime.fromisoformat(value))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports trades or candles from the db.")
+    parser.add_argument("table", choices=TABLES)
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["parquet", "arrow", "csv"],
+                        default="parquet" if pa else "csv")
+    parser.add_argument("--exchange")
+    parser.add_argument("--market")
+    parser.add_argument("--start", type=parse_time)
+    parser.add_argument("--end", type=parse_time)
+    parser.add_argument("--resolution", type=int, help="candles only, in secs")
+    args = parser.parse_args()
+    if args.resolution and args.table != "candles":
+        parser.error("--resolution is for candles only")
+
+    count = export(args.table, args.path, args.format, exchange=args.exchange,
+                   market=args.market, start=args.start, end=args.end, resolution=args.resolution)
+    print(f"Exported {count} {args.table} to {args.path}.")
@@ -1,18 +1,38 @@
 import os
+import random
 import time
 import urllib.parse
-from typing import Optional, Dict, Any, List
+from collections import defaultdict
+from threading import Lock
+from typing import Optional, Dict, Any, List, Tuple
 
-from requests import Request, Session, Response
+from requests import Request, Session, Response, PreparedRequest
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
 import hmac
 from ciso8601 import parse_datetime
 
 
 class FtxClient:
     _ENDPOINT = os.getenv("END_P0INT")
+    _RETRY_STATUSES = {429, 500, 502, 503, 504}
+    _IDEMPOTENT_METHODS = {'GET', 'DELETE'}  # only these are retried on 5xx or connection errors
 
-    def __init__(self, api_key=None, api_secret=None, subaccount_name=None) -> None:
+    def __init__(self, api_key=None, api_secret=None, subaccount_name=None, pool_size: int = 10,
+                 timeout: Tuple[float, float] = (3.05, 10), max_retries: int = 3,
+                 backoff: float = 0.5, max_backoff: float = 10) -> None:
         self._session = Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._session.headers['Accept-Encoding'] = 'gzip, deflate'  # decompressed by requests
+        self._timeout = timeout  # (connect, read) in secs
+        self._max_retries = max_retries
+        self._backoff = backoff  # in secs, doubled at each retry, then jittered
+        self._max_backoff = max_backoff
+        self._latencies: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+        self._latencies_lock = Lock()
         self._api_key = os.getenv("FTX_API_KEY")
         self._api_secret = os.getenv("FTX_API_SECRET")
         self._subaccount_name = subaccount_name
@@ -27,23 +47,65 @@ class FtxClient:
         return self._request('DELETE', path, json=params)
 
     def _request(self, method: str, path: str, **kwargs) -> Any:
-        request = Request(method, self._ENDPOINT + path, **kwargs)
-        self._sign_request(request)
-        response = self._session.send(request.prepare())
-        return self._process_response(response)
-
-    def _sign_request(self, request: Request) -> None:
+        prepared = self._session.prepare_request(Request(method, self._ENDPOINT + path, **kwargs))
+        # ^ encoded once; only the signature headers change between the retries
+        endpoint = f'{method} {path.split("?")[0]}'
+        attempt = 0
+        while True:
+            self._sign_request(prepared)
+            started = time.perf_counter()
+            try:
+                response = self._session.send(prepared, timeout=self._timeout)
+            except (ConnectionError, Timeout):
+                if attempt >= self._max_retries or method not in self._IDEMPOTENT_METHODS:
+                    raise
+                response = None
+            self._record_latency(endpoint, time.perf_counter() - started)
+
+            if response is not None and (
+                    response.status_code not in self._RETRY_STATUSES
+                    or attempt >= self._max_retries
+                    or (response.status_code != 429 and method not in self._IDEMPOTENT_METHODS)):
+                return self._process_response(response)
+            time.sleep(self._get_retry_delay(attempt, response))
+            attempt += 1
+
+    def _get_retry_delay(self, attempt: int, response: Optional[Response]) -> float:
+        """the Retry-After header if the server sent one, jittered exponential backoff otherwise"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self._max_backoff)
+            except ValueError:
+                pass  # an HTTP date, not worth parsing
+        return random.uniform(0, min(self._backoff * 2 ** attempt, self._max_backoff))
+
+    def _record_latency(self, endpoint: str, seconds: float) -> None:
+        with self._latencies_lock:
+            stats = self._latencies[endpoint]
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+
+    def get_latencies(self) -> Dict[str, Dict[str, float]]:
+        """per endpoint, e.g. 'GET markets': count, avg and max of the requests, in secs"""
+        with self._latencies_lock:
+            return {endpoint: {'count': stats['count'], 'avg': stats['total'] / stats['count'],
+                               'max': stats['max']}
+                    for endpoint, stats in self._latencies.items()}
+
+    def _sign_request(self, prepared: PreparedRequest) -> None:
         ts = int(time.time() * 1000)
-        prepared = request.prepare()
         signature_payload = f'{ts}{prepared.method}{prepared.path_url}'.encode()
         if prepared.body:
-            signature_payload += prepared.body
+            body = prepared.body
+            signature_payload += body if isinstance(body, bytes) else body.encode()
         signature = hmac.new(self._api_secret.encode(), signature_payload, 'sha256').hexdigest()
-        request.headers['FTX-KEY'] = self._api_key
-        request.headers['FTX-SIGN'] = signature
-        request.headers['FTX-TS'] = str(ts)
+        prepared.headers['FTX-KEY'] = self._api_key
+        prepared.headers['FTX-SIGN'] = signature
+        prepared.headers['FTX-TS'] = str(ts)
         if self._subaccount_name:
-            request.headers['FTX-SUBACCOUNT'] = urllib.parse.quote(self._subaccount_name)
+            prepared.headers['FTX-SUBACCOUNT'] = urllib.parse.quote(self._subaccount_name)
 
     def _process_response(self, response: Response) -> Any:
         try:
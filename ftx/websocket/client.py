@@ -1,22 +1,98 @@
 import hmac
 import json
+import re
 import time
 import zlib
 import os
 
 from collections import defaultdict, deque
 from itertools import zip_longest
-from typing import DefaultDict, Deque, List, Dict, Tuple, Optional
+from threading import Lock
+from typing import Any, Callable, DefaultDict, Deque, List, Dict, NamedTuple, Tuple, Optional
 from gevent.event import Event
 
 from .websocket_manager import WebsocketManager
 
+try:  # faster decoders, both optional: `pipenv install orjson msgspec`
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    loads = orjson.loads
+elif msgspec is not None:
+    loads = msgspec.json.decode
+else:
+    loads = json.loads
+
+# top-level fields of the frames, read without decoding them; FTX sends them before the data
+_TYPE = re.compile(r'"type"\s*:\s*"([^"]*)"')
+_CHANNEL = re.compile(r'"channel"\s*:\s*"([^"]*)"')
+
+if msgspec is not None:  # trades frames decoded straight into these, no dict in between
+    class TradeRecord(msgspec.Struct, gc=False):
+        id: Optional[int]
+        price: float
+        size: float
+        side: str
+        liquidation: bool
+        time: str
+
+    class TradesFrame(msgspec.Struct, gc=False):
+        market: str
+        data: List[TradeRecord]
+
+    decode_trades: Callable[[str], TradesFrame] = msgspec.json.Decoder(TradesFrame).decode
+else:  # same attributes, from the decoded dicts
+    class TradeRecord(NamedTuple):
+        id: Optional[int]
+        price: float
+        size: float
+        side: str
+        liquidation: bool
+        time: str
+
+    class TradesFrame(NamedTuple):
+        market: str
+        data: List[TradeRecord]
+
+    def decode_trades(raw_message: str) -> TradesFrame:
+        message = loads(raw_message)
+        return TradesFrame(message['market'], [
+            TradeRecord(data.get('id'), data['price'], data['size'], data['side'],
+                        data['liquidation'], data['time'])
+            for data in message['data']])
+
+
+def peek_field(pattern: re.Pattern, raw_message: str) -> Optional[str]:
+    """a top-level string field of the frame, e.g. its channel, before the data if any"""
+    data_at = raw_message.find('"data"')
+    match = pattern.search(raw_message, 0, data_at if data_at != -1 else len(raw_message))
+    return match.group(1) if match else None
+
 
 class FtxWebsocketClient(WebsocketManager):
     _ENDPOINT = 'wss://ftx.com/ws/'
 
-    def __init__(self) -> None:
+    def __init__(self, compact_trades: bool = False) -> None:
+        """compact_trades: trades frames are decoded into TradeRecord's, see decode_trades"""
         super().__init__()
+        # channel => (decoder, handler); frames of the other channels are dropped undecoded
+        self._handlers: Dict[str, Tuple[Callable[[str], Any], Callable[[Any], None]]] = {
+            'orderbook': (loads, self._handle_orderbook_message),
+            'trades': (decode_trades, self._handle_trade_records) if compact_trades
+            else (loads, self._handle_trades_message),
+            'ticker': (loads, self._handle_ticker_message),
+            'fills': (loads, self._handle_fills_message),
+            'orders': (loads, self._handle_orders_message),
+        }
+        self._decode_costs: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+        self._decode_costs_lock = Lock()
         self._trades: DefaultDict[str, Deque] = defaultdict(lambda: deque([], maxlen=10000))
         self._fills: Deque = deque([], maxlen=10000)
         self._api_key = os.getenv("FTX_API_KEY")
@@ -155,6 +231,9 @@ class FtxWebsocketClient(WebsocketManager):
     def _handle_trades_message(self, message: Dict) -> None:
         self._trades[message['market']].append(message['data'])
 
+    def _handle_trade_records(self, frame: TradesFrame) -> None:
+        self._trades[frame.market].append(frame.data)
+
     def _handle_ticker_message(self, message: Dict) -> None:
         self._tickers[message['market']] = message['data']
 
@@ -167,24 +246,38 @@ class FtxWebsocketClient(WebsocketManager):
         self._orders.update({data['id']: data})
 
     def _on_message(self, ws, raw_message: str) -> None:
-        message = json.loads(raw_message)
-        message_type = message['type']
-        if message_type in {'subscribed', 'unsubscribed'}:
+        started = time.perf_counter()
+        message_type = peek_field(_TYPE, raw_message)
+        if message_type in {'update', 'partial'}:
+            channel = peek_field(_CHANNEL, raw_message)
+            decode, handle = self._handlers.get(channel, (None, None))
+            if decode is None:  # not consumed
+                self._record_decode_cost('skipped', time.perf_counter() - started)
+                return
+            message = decode(raw_message)
+            self._record_decode_cost(channel, time.perf_counter() - started)
+            return handle(message)
+        elif message_type in {'subscribed', 'unsubscribed', 'pong'}:
             return
-        elif message_type == 'info':
+
+        message = loads(raw_message)
+        if message['type'] == 'info':
             if message['code'] == 20001:
                 return self.reconnect()
-        elif message_type == 'error':
+        elif message['type'] == 'error':
             raise Exception(message)
-        channel = message['channel']
-
-        if channel == 'orderbook':
-            self._handle_orderbook_message(message)
-        elif channel == 'trades':
-            self._handle_trades_message(message)
-        elif channel == 'ticker':
-            self._handle_ticker_message(message)
-        elif channel == 'fills':
-            self._handle_fills_message(message)
-        elif channel == 'orders':
-            self._handle_orders_message(message)
\ No newline at end of file
+
+    def _record_decode_cost(self, channel: str, seconds: float) -> None:
+        with self._decode_costs_lock:
+            stats = self._decode_costs[channel]
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+
+    def get_decode_costs(self) -> Dict[str, Dict[str, float]]:
+        """per channel, and 'skipped' for the ones not consumed: count, avg and max, in microsecs"""
+        with self._decode_costs_lock:
+            return {channel: {'count': stats['count'],
+                              'avg': stats['total'] / stats['count'] * 1e6,
+                              'max': stats['max'] * 1e6}
+                    for channel, stats in self._decode_costs.items()}
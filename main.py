@@ -5,27 +5,43 @@ import threading
 import time as time_module
 
 from threading import Thread
-from datetime import datetime, timedelta, timezone
-from typing import Generator, Tuple
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Generator, List, Tuple
 
-from sqlalchemy.orm import sessionmaker
-
-from db import engine, get_or_create
-from db import Exchange, Trade, Candle
+from db import get_or_create, to_epoch_us, now_epoch_us, from_units, US_PER_SECOND
+from db import Exchange, Market, Trade, Candle, OpenInterest
+from candle_service import CandleCache, serve_candles
+from storage import storage
 
 import exchanges
+import retention
+from tape import TapeWriter
 
 # globals
 COMMIT_EVERY_N_OBJECT = int(os.getenv("COMMIT_EVERY_N_OBJECT"))
 DELAY_SECONDS_FROM_MINUTE = int(os.getenv("DELAY_SECONDS_FROM_MINUTE"))
 ALERT_IF_Q_SIZE_MORE_THAN = int(os.getenv("ALERT_IF_Q_SIZE_MORE_THAN"))
+CANDLE_CACHE_SIZE = int(os.getenv("CANDLE_CACHE_SIZE", "1000"))  # per exchange, market, resl.
+CANDLE_SERVICE_PORT = int(os.getenv("CANDLE_SERVICE_PORT", "8765"))
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "0"))  # trades older are archived; 0: never
+RETENTION_EVERY_SECONDS = int(os.getenv("RETENTION_EVERY_SECONDS", "3600"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "5000"))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "1000"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+TAPE_DIR = os.getenv("TAPE_DIR")  # columnar trade tape for research; not kept if not set
+CANDLE_RESOLUTIONS_STR = os.getenv("CANDLE_RESOLUTIONS", "60,3600,86400")  # finest first
+# how long after its end, in trade times, a candle still takes trades before it is final
+ALLOWED_LATENESS_US = int(float(os.getenv("ALLOWED_LATENESS_SECONDS", "2")) * US_PER_SECOND)
 
 # todo: make these 2 local for better testability
 exchange_list = []
 job_queue = queue.Queue()  # thread safe
+candle_cache = CandleCache(CANDLE_CACHE_SIZE)  # recent candles for the readers, thread safe
+tape_writer = TapeWriter(TAPE_DIR, hold_us=ALLOWED_LATENESS_US) if TAPE_DIR else None
+# (exchange, market) => (price increment, size increment); prices, sizes are in ticks, lots
+market_increments: Dict[Tuple[str, str], Tuple[float, float]] = {}
 
-Session = sessionmaker(bind=engine)
-session = Session()
+session = storage.writer_session()  # the only writer; readers use storage.reader_session()
 
 
 # TODO:
@@ -44,6 +60,23 @@ def parse_input(input_str: str) -> Generator[Tuple[str, list], None, None]:
         yield exchange_name, markets
 
 
+def parse_resolutions(input_str: str) -> List[int]:
+    """
+    parses resolutions in secs, e.g. "15,60,300"; sorts them finest first
+    each resolution has to be a multiple of the finer one for candles to be rolled up
+    """
+    resolutions = sorted({int(resolution) for resolution in input_str.replace(" ", "").split(",")})
+    for finer, coarser in zip(resolutions, resolutions[1:]):
+        if coarser % finer:
+            raise ValueError(f"Resolution {coarser} is not a multiple of {finer}!")
+    if resolutions[-1] > 86_400 and resolutions[-1] % 86_400:
+        raise ValueError(f"Resolution {resolutions[-1]} is not a multiple of a day!")
+    return resolutions
+
+
+CANDLE_RESOLUTIONS = parse_resolutions(CANDLE_RESOLUTIONS_STR)
+
+
 def parse_input_and_subscribe_to_markets(input_str: str) -> None:
     for exchange_name, markets in parse_input(input_str):
         try:
@@ -54,16 +87,111 @@ def parse_input_and_subscribe_to_markets(input_str: str) -> None:
 
         get_or_create(session, Exchange, name=exchange_name, commit=True)  # add to db
         exchange_obj = exchange_cls(markets, job_queue)
+        exchange_obj.load_increments()
+        for market, (price_increment, size_increment) in exchange_obj.increments.items():
+            get_or_create(session, Market, exchange_name=exchange_name, name=market,
+                          update={"price_increment": price_increment,
+                                  "size_increment": size_increment})
+            market_increments[(exchange_name, market)] = (price_increment, size_increment)
+            candle_cache.increments[(exchange_name, market)] = (price_increment, size_increment)
+        session.commit()
         exchange_list.append(exchange_obj)
         print(f"Exchange: {exchange_name}. Markets: {markets}.")
 
 
 item_count = 0
 
+# the finest candles of each (exchange, market) still receiving trades, by start time; two around
+# the turn of a period, until the older one is final. Coarser ones are rolled up
+open_candles: Dict[Tuple[str, str], Dict[int, Candle]] = {}
+# (exchange, market, start time) => [first, last] trade times of each open finest candle, as the
+# trades may come out of order; -inf for the candle obtained via REST, its open is kept
+trade_times: Dict[Tuple[str, str, int], List[float]] = {}
+# time up to which the candles of each (exchange, market) are final, with trades or not; a trade
+# whose finest candle ends by then is late
+rolled_up_until: Dict[Tuple[str, str], int] = {}
+# event time of each (exchange, market): the latest trade time minus ALLOWED_LATENESS_US, i.e.
+# not the clock; candles ending by it are final, and trades of a final candle are late
+watermarks: Dict[Tuple[str, str], int] = {}
+late_trade_counts: Dict[Tuple[str, str], int] = {}  # not applied to the candles, see below
+# (exchange, market, resolution, start time) => volume of the candles of the current periods
+# obtained via REST at the very first pull; the coarser ones contain the volume of the finer ones
+# already, so it is not rolled up again
+seeded_volumes: Dict[Tuple[str, str, int, int], int] = {}
+
+
+def update_candle_with_trade(candle: Candle, created: bool, trade: Trade,
+                             times: List[float]) -> None:
+    """applies a single trade to the candle; times: [first, last] trade times, updated"""
+    if created:  # start a candle
+        print("\na trade started a candle")
+        candle.open = candle.high = candle.low = candle.close = trade.price
+        candle.volume = 0
+        times[:] = [trade.time, trade.time]
+    if trade.time >= times[1]:  # the latest trade will be effective
+        candle.close, times[1] = trade.price, trade.time
+    if trade.time < times[0]:  # an earlier trade came after
+        candle.open, times[0] = trade.price, trade.time
+    candle.volume += trade.size * trade.price
+    candle.low = min(candle.low, trade.price)
+    candle.high = max(candle.high, trade.price)
+    candle_cache.put(candle)
+
+
+def merge_candle(coarser: Candle, created: bool, finer: Candle, merged_volume: int = 0) -> None:
+    """
+    rolls a finished finer candle up into the coarser candle that contains it
+    merged_volume: of the finer candle, already in the coarser one
+    """
+    coarser.close = finer.close  # finer candles come in order, last will be effective
+    if created:
+        coarser.open = finer.open
+        coarser.high, coarser.low, coarser.volume = finer.high, finer.low, 0
+    coarser.volume += finer.volume - merged_volume
+    coarser.low = min(coarser.low, finer.low)
+    coarser.high = max(coarser.high, finer.high)
+
+
+def roll_up_finished_candles(key: Tuple[str, str], until: int) -> None:
+    """
+    finalizes the open finest candles of the (exchange, market) that have ended by `until`, in
+    order, and rolls them up; each coarser candle is only rolled further up once it has ended as
+    well, e.g. the hour candle goes into the day candle only after its last minute candle is
+    """
+    candles = open_candles.get(key, {})
+    for start_time in sorted(start for start, c in candles.items() if c.end_time <= until):
+        candle = candles.pop(start_time)
+        trade_times.pop((*key, start_time), None)
+        candle_cache.put(candle, closed=True)
+        roll_up_candle(candle, until)
+    rolled_up_until[key] = max(rolled_up_until.get(key, until), until)
+
+
+def roll_up_candle(candle: Candle, until: int) -> None:
+    """merges the final finest candle into the coarser ones, as far as those have ended"""
+    for resolution in CANDLE_RESOLUTIONS[1:]:
+        coarser, created = get_or_create(
+            session, Candle,
+            exchange_name=candle.exchange_name,
+            market=candle.market,
+            start_time=candle.start_time - candle.start_time % (resolution * US_PER_SECOND),
+            resolution=resolution,
+        )
+        seeded_volume = seeded_volumes.pop(
+            (candle.exchange_name, candle.market, candle.resolution, candle.start_time), 0)
+        merge_candle(coarser, created, candle, 0 if created else seeded_volume)
+        closed = coarser.end_time <= until
+        candle_cache.put(coarser, closed=closed)
+        if not closed:
+            break  # will be rolled up when its last finer candle is
+        candle = coarser
+
 
 def save_trade_and_update_candle(trade_dict: dict) -> None:
     """
-    save trades to the db and update all 3 candles: min, hour, day
+    save trades to the db and update the candle of the finest resolution only
+    coarser candles are rolled up from the finer ones when those are final, i.e. as soon as the
+    watermark of the market passes their end; not waiting for the REST pull
     the candle updated here is the one obtained via REST for the very first period
     subsequent candles are started from the first trade received via WebSocket
     """
@@ -75,31 +203,50 @@ def save_trade_and_update_candle(trade_dict: dict) -> None:
         price=trade_dict["price"],
         side=trade_dict["side"],
         size=trade_dict["size"],
-        time=trade_dict["time"].timestamp(),
+        time=to_epoch_us(trade_dict["time"]),
     )
 
-    # update candles
-    for period in get_current_candle_periods(trade_dict["time"]):
+    key = (trade.exchange_name, trade.market)
+    start_time = to_epoch_us(get_period_start(trade_dict["time"], CANDLE_RESOLUTIONS[0]))
+    end_time = start_time + CANDLE_RESOLUTIONS[0] * US_PER_SECOND
+
+    if end_time <= rolled_up_until.get(key, float("-inf")):
+        # late trade, its candle is final; kept in the trades, the candles can be rebuilt from
+        # them with batch_candles.py
+        late_trade_counts[key] = late_trade_counts.get(key, 0) + 1
+        candle_cache.set_watermark(*key, watermarks.get(key), late_trade_counts[key])
+        print(f"\nlate trade ({late_trade_counts[key]} so far), not applied: {trade}")
+        return
+
+    candles = open_candles.setdefault(key, {})
+    candle, created = candles.get(start_time), False
+    if candle is None:
         candle, created = get_or_create(
             session, Candle,
             exchange_name=trade.exchange_name,
             market=trade.market,
-            start_time=period["start_time"].timestamp(),
-            resolution=period["resolution"],
+            start_time=start_time,
+            resolution=CANDLE_RESOLUTIONS[0],
         )
-        candle.close = trade.price  # last trade will be effective
-        # ^ assignment needs to be before session.commit()
-        if created:  # start a candle
-            print("\na trade started a candle")
-            candle.open = trade.price
-            session.commit()  # to get the default values which are at the SQL side
-        candle.volume += trade.size * trade.price
-        candle.low = min(candle.low, trade.price)
-        candle.high = max(candle.high, trade.price)
+        candles[start_time] = candle
+    times = trade_times.setdefault((*key, start_time), [float("-inf"), float("-inf")])
+    update_candle_with_trade(candle, created, trade, times)
+
+    watermark = trade.time - ALLOWED_LATENESS_US
+    if watermark > watermarks.get(key, float("-inf")):
+        watermarks[key] = watermark
+        roll_up_finished_candles(key, until=watermark)
+        candle_cache.set_watermark(*key, watermark, late_trade_counts.get(key, 0))
 
 
 def save_candle_received_and_compare_with_calculated(received: dict) -> None:
     """ saves candle received from the REST API and compares to the one calculated from trades"""
+    # make sure the finer candles of the period are final, even if no trade came after it to move
+    # the watermark past their end, e.g. in a quiet market
+    roll_up_finished_candles(
+        (received["exchange"], received["market"]),
+        until=min(received["time"] + received["resolution"] * US_PER_SECOND, now_epoch_us()),
+    )
     calculated = session.query(Candle).filter_by(
         exchange_name=received["exchange"],
         market=received["market"],
@@ -108,7 +255,7 @@ def save_candle_received_and_compare_with_calculated(received: dict) -> None:
     ).first()
     if calculated is None:
         print("No trades prior to the received candles, nothing to compare!!")
-        get_or_create(
+        calculated, _ = get_or_create(
             session, Candle,
             exchange_name=received["exchange"],
             market=received["market"],
@@ -120,19 +267,25 @@ def save_candle_received_and_compare_with_calculated(received: dict) -> None:
             high=received["high"],
             volume=received["volume"],
         )
+        if calculated.end_time > now_epoch_us():  # the current period, at the very first pull
+            seeded_volumes[(received["exchange"], received["market"], received["resolution"],
+                            received["time"])] = received["volume"]
     else:
         print("\n" + f"comparing candles received to calculated "
                      f"(resolution {calculated.resolution})".rjust(120, "_"))
         discrepancy_found = False
+        price_increment, size_increment = market_increments[
+            (received["exchange"], received["market"])]
         for attr in ["open", "close", "high", "low", "volume", ]:
             left = getattr(calculated, attr)
             right = received[attr]
-            if not left == right:
+            if not left == right:  # exact, both are in ticks (or ticks * lots for the volume)
                 discrepancy_found = True
-                # print a report
-                abs_diff = round(abs(left - right), 3)
-                left_vs_right = f"{round(left, 3)} vs {round(right, 3)}"
-                percent_diff = round(abs(left - right) / right * 100, 3)
+                # print a report, in prices
+                increment = price_increment * (size_increment if attr == "volume" else 1)
+                abs_diff = from_units(abs(left - right), increment)
+                left_vs_right = f"{from_units(left, increment)} vs {from_units(right, increment)}"
+                percent_diff = round(abs(left - right) / right * 100, 3) if right else "inf"
                 print(f"DISCREPANCY FOUND FOR {attr.ljust(7)}: diff:"
                       f" {str(abs_diff).ljust(15)}"
                       f", {str(left_vs_right).ljust(25)}"
@@ -144,6 +297,29 @@ def save_candle_received_and_compare_with_calculated(received: dict) -> None:
         print("\n".ljust(120, "_"))  # separator
         # tofix: issue with the volume
 
+    closed = calculated.end_time <= now_epoch_us()  # not the very first pull
+    candle_cache.put(calculated, closed=closed)
+
+
+def save_open_interest(item: dict) -> None:
+    """saves the open interest of all markets of the exchange at the close of the interval"""
+    session.bulk_insert_mappings(OpenInterest, [
+        {"exchange_name": item["exchange"], "time": item["time"], **row} for row in item["futures"]
+    ])
+
+
+def archive_old_trades() -> None:
+    """
+    archives a batch of the trades older than RETENTION_DAYS and frees some of the db pages
+    a batch at a time, so the trades queued meanwhile are not stalled; queues itself for the rest
+    """
+    before = now_epoch_us() - int(RETENTION_DAYS * 86_400 * US_PER_SECOND)
+    count = retention.archive_trades(session, before, RETENTION_BATCH_SIZE, ARCHIVE_DIR)
+    retention.vacuum_incrementally(session, RETENTION_VACUUM_PAGES)
+    print(f"\nArchived {count} trades older than {RETENTION_DAYS} days.")
+    if count == RETENTION_BATCH_SIZE:  # more to go
+        job_queue.put({"type": "retention"})
+
 
 def process_queue_item(item) -> None:
     """processes each queue item; saves objects to db for every COMMIT_EVERY_N_OBJECT of them"""
@@ -157,13 +333,21 @@ def process_queue_item(item) -> None:
 
     if item["type"] == "candle":
         save_candle_received_and_compare_with_calculated(item)
+    elif item["type"] == "open_interest":
+        save_open_interest(item)
+    elif item["type"] == "retention":
+        archive_old_trades()
     elif item["type"] == "trade":
         save_trade_and_update_candle(item)
+        if tape_writer:
+            tape_writer.append(item)
         print("t", end="", flush=True)
 
     if item_count % COMMIT_EVERY_N_OBJECT == 0:
         print(" - committing trades to db..")
         session.commit()
+        if tape_writer:
+            tape_writer.flush()
 
 
 def process_queue() -> None:
@@ -177,51 +361,48 @@ def process_queue() -> None:
             time_module.sleep(0.1)
 
 
-def get_current_candle_periods(time: datetime) -> Generator[dict, None, None]:
+def get_period_start(time: datetime, resolution: int) -> datetime:
     """
-    primarily for determining the periods of the trades coming in via websocket
-    but is used for pulling candles via REST for its very initial pull
-    when trades coming in, this will tell us which local candles to update
-    brings the start time of min, hour, day that we are currently in, not over.
-    will always return all three of min, hour, day
+    brings the start time of the period of the given resolution that the time is in
+    periods up to a day are aligned to the midnight, multi-day ones to the Unix epoch
     """
+    midnight = time.replace(hour=0, minute=0, second=0, microsecond=0)
+    if resolution > 86_400:
+        days = (time.date() - date(1970, 1, 1)).days
+        return midnight - timedelta(days=days % (resolution // 86_400))
+    seconds = (time - midnight).seconds  # 11:46:03 => 42363
+    return midnight + timedelta(seconds=seconds - seconds % resolution)  # 60 => 11:46:00
 
-    time = time.replace(second=0, microsecond=0)  # 11:46:03 => 11:46:00
-    yield {"start_time": time, "resolution": 60}
-
-    time = time.replace(minute=0)  # 11:46:03 => 11:00:00
-    yield {"start_time": time, "resolution": 3_600}
 
-    time = time.replace(hour=0)  # 11:46:03 => 00:00:00
-    yield {"start_time": time, "resolution": 86_400}
+def get_current_candle_periods(
+        time: datetime, resolutions: List[int] = None) -> Generator[dict, None, None]:
+    """
+    used for pulling candles via REST for its very initial pull
+    brings the start time of each resolution that we are currently in, not over.
+    will always return all of the resolutions, e.g. min, hour, day
+    """
+    for resolution in resolutions or CANDLE_RESOLUTIONS:
+        yield {"start_time": get_period_start(time, resolution), "resolution": resolution}
 
 
-def get_turned_candle_periods(time) -> Generator[dict, None, None]:  # i.e. min, hour, day
+def get_turned_candle_periods(
+        time, resolutions: List[int] = None) -> Generator[dict, None, None]:  # i.e. min, hour, day
     """
     used to pull candles from the REST API (except the very first pull, see ^)
-    brings the start time of min, hour, day that has just turned; see -1's below
+    brings the start time of the periods that have just turned
+    this is a minute-ly job, so resolutions finer than a minute bring their last period only
     """
     print(f"{'Now: '.ljust(50)}: {time}")
 
     time = time.replace(second=0, microsecond=0)  # 11:46:03 => 11:46:00
 
-    min_start_time = time + timedelta(minutes=-1)  # 11:46:03 => 11:45:00
-    print(f"{'Getting the minute candle starting at: '.ljust(50)}: {min_start_time}")
-
-    # minute job; always deliver bc this is a minute-ly job
-    yield {"start_time": min_start_time, "resolution": 60}
+    for resolution in resolutions or CANDLE_RESOLUTIONS:
+        if get_period_start(time, resolution) != time:
+            continue  # period not over yet, e.g. hour job at 11:46:00
 
-    # hour job
-    if time.minute == 0:
-        hr_start_time = time + timedelta(hours=-1)  # 11:00:03 => 10:00:00
-        print(f"{'Getting the hour candle starting at: '.ljust(50)}: {hr_start_time}")
-        yield {"start_time": hr_start_time, "resolution": 3_600}
-
-        # day job
-        if time.hour == 0:
-            day_start_time = time + timedelta(days=-1)  # 00:00:03 => 00:00:00 prev day
-            print(f"{'Getting the day candle starting at: '.ljust(50)}: {day_start_time}")
-            yield {"start_time": day_start_time, "resolution": 86_400}
+        start_time = time - timedelta(seconds=resolution)  # 60 => 11:45:00
+        print(f"{f'Getting the {resolution}s candle starting at: '.ljust(50)}: {start_time}")
+        yield {"start_time": start_time, "resolution": resolution}
 
 
 def get_candles(first_time: bool = False) -> None:
@@ -243,7 +424,7 @@ def get_candles(first_time: bool = False) -> None:
     delay_get_candles(delay)  # schedule next run
 
     periods = get_current_candle_periods(now) if first_time else get_turned_candle_periods(now)
-    # i.e. min, hour, day
+    # i.e. CANDLE_RESOLUTIONS, e.g. min, hour, day
 
     print("\n" + "Getting candles via REST".rjust(120, "_"))
     for period in periods:
@@ -253,9 +434,28 @@ def get_candles(first_time: bool = False) -> None:
                 resolution=period["resolution"],
             )
 
+    if not first_time:  # record open interest at the close of the intervals turned, e.g. minute
+        close_time = now.replace(second=0, microsecond=0)
+        for exch in exchange_list:
+            exch.get_open_interest(close_time)
+
+    for exch in exchange_list:  # latency of the REST calls per endpoint, decoding cost per channel
+        print(f"{exch.name} REST latencies, in secs: {exch.rest.get_latencies()}")
+        print(f"{exch.name} websocket decoding, in microsecs: {exch.websocket.get_decode_costs()}")
+
+
+def queue_retention() -> None:
+    """queues the archiving of the old trades, to be run by the only writer: the queue consumer"""
+    delay_retention()  # schedule next run
+    job_queue.put({"type": "retention"})
+
+
+def delay_retention() -> None:
+    threading.Timer(RETENTION_EVERY_SECONDS, queue_retention).start()
+
 
 def delay_get_candles(delay: int = None) -> None:
-    """ candles will be received at the turn of each period: min, hr, day + few secs of offset """
+    """ candles will be received at the turn of each period, e.g. min, hr, day + few secs offset """
     threading.Timer(delay, get_candles).start()
 
 
@@ -268,8 +468,14 @@ if __name__ == "__main__":
     # could be replaced with ThreadPoolExecutor if 1 Thread is not enough
     Thread(target=process_queue).start()
 
+    # recent candles for the strategies, without competing with the writer above for the db
+    Thread(target=serve_candles, args=(candle_cache, CANDLE_SERVICE_PORT), daemon=True).start()
+
     get_candles(first_time=True)
     # will reschedule itself to the turn of the minute first time, and a min thereafter
 
+    if RETENTION_DAYS:
+        queue_retention()  # will reschedule itself every RETENTION_EVERY_SECONDS
+
     for exchange in exchange_list:
         exchange.subscribe_to_trades()  # after getting the initial trades
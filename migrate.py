@@ -0,0 +1,188 @@
+"""
+migrates an existing db in place to the current schema version, in chunks; stop the ingest first
+can be interrupted and run again, it continues where it left off
+usage: python migrate.py [chunk_size]
+"""
+import sys
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+from sqlalchemy import inspect
+
+from db import Base, Market, SCHEMA_VERSION
+from storage import storage
+
+import exchanges
+
+DEFAULT_CHUNK_SIZE = 50_000
+
+# version 2: float seconds => integer microseconds, exact after rounding as floats had microsecs
+TIME_COLUMNS_V2 = {"trade": "time", "candle": "start_time", "open_interest": "time"}
+
+# (table, version) of the tables converted so far, until the db is at that version; a table is
+# marked in the transaction dropping its old copy, so it is never converted twice
+STATE_TABLE_NAME = "migration_state"
+
+
+@contextmanager
+def transaction():
+    """a connection in a transaction that covers the DDL too; the driver only begins one for DML"""
+    with storage.writer_engine.begin() as connection:
+        connection.exec_driver_sql("BEGIN")
+        yield connection
+
+
+def get_schema_version() -> int:
+    with storage.writer_engine.connect() as connection:
+        return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def set_schema_version(version: int) -> None:
+    """and forgets the tables converted on the way, in the same transaction"""
+    with transaction() as connection:
+        connection.exec_driver_sql(f"PRAGMA user_version = {version}")
+        connection.exec_driver_sql(f"DROP TABLE IF EXISTS {STATE_TABLE_NAME}")
+
+
+def is_table_migrated(table_name: str, version: int) -> bool:
+    with storage.writer_engine.begin() as connection:
+        connection.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {STATE_TABLE_NAME} "
+            f"(table_name VARCHAR NOT NULL, version INTEGER NOT NULL, "
+            f"PRIMARY KEY (table_name, version))")
+        return connection.exec_driver_sql(
+            f"SELECT 1 FROM {STATE_TABLE_NAME} WHERE table_name = ? AND version = ?",
+            (table_name, version)).first() is not None
+
+
+def mark_table_migrated(connection, table_name: str, version: int) -> None:
+    connection.exec_driver_sql(
+        f"INSERT INTO {STATE_TABLE_NAME} (table_name, version) VALUES (?, ?)",
+        (table_name, version))
+
+
+def rebuild_table(table_name: str, version: int, select_exprs: dict, chunk_size: int,
+                  joins: str = "") -> None:
+    """
+    recreates the table with the current schema, copying the rows over in chunks of ids
+    each chunk is committed on its own, so that the db is never locked for long
+    select_exprs: column name => sql expression over the old table (aliased `old`) and the joins,
+    for the converted columns
+    """
+    table = Base.metadata.tables[table_name]
+    old_table_name = f"{table_name}_v{version - 1}"
+    if is_table_migrated(table_name, version):
+        print(f"{table_name}: converted already, skipping.")
+        return
+
+    table_names = inspect(storage.writer_engine).get_table_names()
+    if table_name in table_names and old_table_name not in table_names:
+        with transaction() as connection:
+            connection.exec_driver_sql(f"ALTER TABLE {table_name} RENAME TO {old_table_name}")
+            for index in table.indexes:  # index names are global, the new table gets them
+                connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+    elif old_table_name not in table_names:
+        print(f"Table {table_name} did not exist, creating.")
+        with transaction() as connection:
+            table.create(connection)
+            mark_table_migrated(connection, table_name, version)
+        return
+    table.create(storage.writer_engine, checkfirst=True)  # with the new indexes
+
+    columns = [column.name for column in table.columns]
+    exprs = [select_exprs.get(column, f"old.{column}") for column in columns]
+    copied = 0
+    while True:
+        with storage.writer_engine.begin() as connection:
+            last_id = connection.exec_driver_sql(
+                f"SELECT COALESCE(MAX(id), 0) FROM {table_name}").scalar()
+            count = connection.exec_driver_sql(
+                f"INSERT INTO {table_name} ({', '.join(columns)}) "
+                f"SELECT {', '.join(exprs)} FROM {old_table_name} AS old {joins} "
+                f"WHERE old.id > ? ORDER BY old.id LIMIT ?",
+                (last_id, chunk_size),
+            ).rowcount
+        copied += count
+        print(f"{table_name}: copied {copied} rows", end="\r", flush=True)
+        if count < chunk_size:
+            break
+
+    with transaction() as connection:
+        connection.exec_driver_sql(f"DROP TABLE {old_table_name}")
+        mark_table_migrated(connection, table_name, version)
+    print(f"{table_name}: copied {copied} rows, done.")
+
+
+def migrate_to_v2(chunk_size: int) -> None:
+    for table_name, column in TIME_COLUMNS_V2.items():
+        rebuild_table(
+            table_name, 2,
+            {column: f"CAST(ROUND(old.{column} * 1000000) AS INTEGER)"},
+            chunk_size,
+        )
+
+
+def load_market_increments() -> None:
+    """saves the price and size increments of the markets in the db, from their exchanges"""
+    Market.__table__.create(storage.writer_engine, checkfirst=True)
+    with storage.writer_engine.connect() as connection:
+        rows = connection.exec_driver_sql(
+            "SELECT exchange_name, market FROM trade "
+            "UNION SELECT exchange_name, market FROM candle "
+            "EXCEPT SELECT exchange_name, name FROM market").fetchall()
+
+    markets = defaultdict(list)
+    for exchange_name, market in rows:
+        markets[exchange_name].append(market)
+
+    session = storage.writer_session()
+    for exchange_name, exchange_markets in markets.items():
+        exchange_obj = getattr(exchanges, exchange_name)(exchange_markets, None)
+        exchange_obj.load_increments()  # raises if a market is not listed anymore
+        for market, (price_increment, size_increment) in exchange_obj.increments.items():
+            print(f"{exchange_name} {market}: price increment {price_increment}, "
+                  f"size increment {size_increment}")
+            session.add(Market(exchange_name=exchange_name, name=market,
+                               price_increment=price_increment, size_increment=size_increment))
+    session.commit()
+    session.close()
+
+
+def migrate_to_v3(chunk_size: int) -> None:
+    load_market_increments()
+    joins = "JOIN market ON market.exchange_name = old.exchange_name AND market.name = old.market"
+    ticks = "CAST(ROUND(old.{} / market.price_increment) AS INTEGER)"
+    rebuild_table("trade", 3, {
+        "price": ticks.format("price"),
+        "size":  "CAST(ROUND(old.size / market.size_increment) AS INTEGER)",
+    }, chunk_size, joins)
+    rebuild_table("candle", 3, {
+        **{attr: ticks.format(attr) for attr in ["open", "close", "high", "low"]},
+        "volume": "CAST(ROUND(old.volume / (market.price_increment * market.size_increment))"
+                  " AS INTEGER)",
+    }, chunk_size, joins)
+
+
+MIGRATIONS = {2: migrate_to_v2, 3: migrate_to_v3}  # version => migrates from the previous one
+
+
+def migrate(chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    version = max(get_schema_version(), 1)  # 0: created before versioning, i.e. 1
+    print(f"Db {storage} is at schema version {version}, current is {SCHEMA_VERSION}.")
+    while version < SCHEMA_VERSION:
+        version += 1
+        print(f"Migrating to version {version}..")
+        MIGRATIONS[version](chunk_size)
+        set_schema_version(version)
+    with storage.writer_engine.connect() as connection:
+        if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:  # 2: incremental
+            print("Vacuuming, once: gives the space of the old tables back and turns on the"
+                  " incremental vacuum that the retention needs..")
+            connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")  # set by the VACUUM
+            connection.exec_driver_sql("VACUUM")
+    print("Db is up to date.")
+
+
+if __name__ == "__main__":
+    migrate(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_CHUNK_SIZE)
@@ -0,0 +1,119 @@
+import gzip
+import os
+import re
+import struct
+
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Generator
+
+from sqlalchemy import func
+
+from db import Trade, US_PER_SECOND
+
+# archive record: id, time (Unix microseconds), price (ticks), size (lots), side (0: buy, 1: sell),
+# liquidation; see the market table for the increments
+RECORD = struct.Struct("<qqqqBB")
+SIDES = ["buy", "sell"]
+# the schema version (see db.py) of the records, in the file names; the files of the older ones
+# have no version and records of the same size, so they are not read, nor appended to
+ARCHIVE_VERSION = 3
+ARCHIVE_NAME = re.compile(r"\.trades\.v(\d+)\.gz$")
+
+
+def get_archive_path(directory: str, exchange: str, market: str, day: str) -> str:
+    """one file per exchange, market and day, e.g. archive/Ftx/BTC-PERP/2021-12-10.trades.v3.gz"""
+    return os.path.join(directory, exchange, market.replace("/", "_"),
+                        f"{day}.trades.v{ARCHIVE_VERSION}.gz")
+
+
+def find_cutoff_id(session, before: int) -> int:
+    """
+    the id of the first trade at or after `before`, as the ids grow with the time (the trades are
+    inserted as they come); a binary search over the primary key, as time alone is not indexed
+    """
+    low = session.query(func.min(Trade.id)).scalar()  # alone, min and max are a lookup each
+    high = session.query(func.max(Trade.id)).scalar()
+    if low is None:
+        return 0
+    high += 1
+    while low < high:
+        middle = (low + high) // 2
+        row = session.query(Trade.id, Trade.time).filter(Trade.id >= middle) \
+            .order_by(Trade.id).first()
+        if row.time < before:
+            low = row.id + 1
+        else:
+            high = middle
+    return low
+
+
+def archive_trades(session, before: int, batch_size: int, directory: str) -> int:
+    """
+    moves up to batch_size trades older than `before` from the db to the compressed archive files
+    files are appended (as new gzip members) and synced before the trades are deleted;
+    if interrupted in between, the next run archives them again, readers should dedupe by id
+    returns the number of trades archived, less than batch_size if there are no more
+    """
+    rows = session.query(
+        Trade.id, Trade.exchange_name, Trade.market, Trade.time,
+        Trade.price, Trade.size, Trade.side, Trade.liquidation,
+    ).filter(
+        Trade.id < find_cutoff_id(session, before),  # a range of the primary key, not a scan
+        Trade.time < before,  # a trade come out of order is left for a later run
+    ).order_by(Trade.id).limit(batch_size).all()
+    if not rows:
+        return 0
+
+    groups = defaultdict(list)
+    for row in rows:
+        day = datetime.fromtimestamp(row.time // US_PER_SECOND, tz=timezone.utc)
+        day = day.strftime("%Y-%m-%d")
+        groups[(row.exchange_name, row.market, day)].append(
+            RECORD.pack(row.id, row.time, row.price, row.size,
+                        SIDES.index(row.side), row.liquidation))
+
+    for (exchange, market, day), records in groups.items():
+        path = get_archive_path(directory, exchange, market, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as file:
+            with gzip.GzipFile(fileobj=file, mode="ab") as archive:
+                archive.write(b"".join(records))
+            file.flush()
+            os.fsync(file.fileno())
+
+    session.query(Trade).filter(Trade.id.in_([row.id for row in rows])) \
+        .delete(synchronize_session=False)
+    session.commit()
+    return len(rows)
+
+
+def read_archive(path: str) -> Generator[dict, None, None]:
+    """reads the trades back from an archive file, in the order archived"""
+    match = ARCHIVE_NAME.search(os.fspath(path))
+    version = int(match.group(1)) if match else None
+    if version != ARCHIVE_VERSION:
+        raise ValueError(f"Archive {path} is of version {version or '1 or 2'}, only version"
+                         f" {ARCHIVE_VERSION} can be read: times in microsecs, prices in ticks!")
+    with gzip.open(path, "rb") as archive:
+        data = archive.read()
+    for id_, time, price, size, side, liquidation in RECORD.iter_unpack(data):
+        yield {
+            "id":          id_,
+            "time":        time,
+            "price":       price,
+            "size":        size,
+            "side":        SIDES[side],
+            "liquidation": bool(liquidation),
+        }
+
+
+def vacuum_incrementally(session, pages: int) -> None:
+    """
+    returns up to `pages` free pages to the file system, so the work per call is bounded
+    only works if the db is created with auto_vacuum=INCREMENTAL, see storage.py and migrate.py
+    """
+    session.commit()
+    session.connection().connection.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+    # ^ runs all the steps; execute() stops after the first one, i.e. frees a single page
+    session.commit()
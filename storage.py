@@ -0,0 +1,161 @@
+"""
+storage backends; main.py writes through one and the readers (candle service, exports, ...) read
+through it, so that the db can be tuned or replaced at a single place
+a backend has a single writer connection and a pool of read-only connections
+"""
+import os
+
+from abc import ABC, abstractmethod
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from db import Base, SCHEMA_VERSION
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")  # sqlite, or memory for the tests
+SQL_FILE_NAME = os.getenv("SQL_FILE_NAME")
+SQLITE_READERS = int(os.getenv("SQLITE_READERS", "4"))  # read-only connections in the pool
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 ** 2)))  # in bytes
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", str(64 * 1024)))  # in KiB, per connection
+
+
+class StorageBackend(ABC):
+    @property
+    @abstractmethod
+    def writer_engine(self) -> Engine:
+        """a single connection, for the only writer"""
+
+    @property
+    @abstractmethod
+    def reader_engine(self) -> Engine:
+        """read-only connections, for the readers"""
+
+    def __init__(self) -> None:
+        self._writer_sessions = sessionmaker(bind=self.writer_engine)
+        self._reader_sessions = sessionmaker(bind=self.reader_engine)
+
+    def writer_session(self) -> Session:
+        """for the only writer, i.e. the queue consumer of main.py, or a script run alone"""
+        return self._writer_sessions()
+
+    def reader_session(self) -> Session:
+        return self._reader_sessions()
+
+    def create_all(self) -> None:
+        with self.writer_engine.connect() as connection:  # before any table, see retention.py
+            connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        Base.metadata.create_all(self.writer_engine)
+        with self.writer_engine.connect() as connection:
+            connection.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    @abstractmethod
+    def reset(self) -> None:
+        """drops everything and creates the tables again"""
+
+    def __str__(self) -> str:
+        return self.__class__.__name__
+
+
+class SqliteBackend(StorageBackend):
+    """
+    a file db tuned for a high write throughput; readers run alongside the writer without
+    blocking it, thanks to the write-ahead log (WAL)
+    """
+
+    def __init__(self, path: str, readers: int = SQLITE_READERS,
+                 mmap_size: int = SQLITE_MMAP_SIZE, cache_size: int = SQLITE_CACHE_SIZE) -> None:
+        self.path = path
+        pragmas = {
+            "busy_timeout": 5_000,  # ms to wait for a lock instead of failing at once
+            "mmap_size":    mmap_size,  # reads straight from the page cache of the OS
+            "cache_size":   -cache_size,  # negative: in KiB, not in pages
+            "temp_store":   "MEMORY",
+        }
+        writer_pragmas = {
+            "auto_vacuum":  "INCREMENTAL",  # first, WAL creates the file; no-op on an existing db
+            "journal_mode": "WAL",  # persistent, i.e. applies to the readers as well
+            "synchronous":  "NORMAL",  # no fsync per commit; safe with WAL, may lose the last one
+            **pragmas,
+        }
+        reader_pragmas = {"query_only": "ON", **pragmas}
+
+        self._writer_engine = create_engine(
+            f"sqlite:///{path}", connect_args={"check_same_thread": False},
+            poolclass=QueuePool, pool_size=1, max_overflow=0)
+        self._reader_engine = create_engine(
+            f"sqlite:///file:{path}?mode=ro&uri=true", connect_args={"check_same_thread": False},
+            poolclass=QueuePool, pool_size=readers, max_overflow=0)
+        self._set_pragmas_on_connect(self._writer_engine, writer_pragmas)
+        self._set_pragmas_on_connect(self._reader_engine, reader_pragmas)
+        super().__init__()
+
+    @property
+    def writer_engine(self) -> Engine:
+        return self._writer_engine
+
+    @property
+    def reader_engine(self) -> Engine:
+        return self._reader_engine
+
+    @staticmethod
+    def _set_pragmas_on_connect(engine: Engine, pragmas: dict) -> None:
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+            cursor.close()
+
+    def reset(self) -> None:
+        self.writer_engine.dispose()
+        self.reader_engine.dispose()
+        for suffix in ["", "-wal", "-shm"]:
+            try:
+                os.remove(self.path + suffix)
+                print(f"Removed file {self.path + suffix}.")
+            except OSError:
+                pass  # file did not exist
+        self.create_all()
+        print(f"Created db: {self.path}.")
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__} ({self.path})"
+
+
+class MemoryBackend(StorageBackend):
+    """
+    a db in memory, for the tests and the benchmarks; gone when the process ends
+    single-threaded: the writer and the readers share its only connection, so the readers are
+    not read-only, and closing a reader session rolls back what the writer has not committed
+    """
+
+    def __init__(self) -> None:
+        self._engine = create_engine(
+            "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        super().__init__()
+        self.create_all()
+
+    @property
+    def writer_engine(self) -> Engine:
+        return self._engine
+
+    @property
+    def reader_engine(self) -> Engine:
+        return self._engine
+
+    def reset(self) -> None:
+        Base.metadata.drop_all(self.writer_engine)
+        self.create_all()
+
+
+def get_storage_backend(name: str = STORAGE_BACKEND) -> StorageBackend:
+    if name == "sqlite":
+        return SqliteBackend(SQL_FILE_NAME)
+    elif name == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Storage backend {name} is not implemented!")
+
+
+storage = get_storage_backend()
@@ -0,0 +1,190 @@
+import os
+
+from array import array
+from datetime import datetime, timezone
+from typing import Dict, Generator, Tuple
+
+import numpy as np
+
+from db import to_epoch_us, now_epoch_us, US_PER_SECOND
+
+# one append-only file per column, per exchange, market and day; fixed width, little endian
+# time: Unix microseconds, price: ticks, size: lots, side: 0 buy 1 sell, liquidation: 0 or 1
+COLUMNS = {"time": "q", "price": "q", "size": "q", "side": "B", "liquidation": "B"}  # array
+DTYPES = {"time": "<i8", "price": "<i8", "size": "<i8", "side": "u1", "liquidation": "u1"}
+SIDES = ["buy", "sell"]
+
+INDEX_EVERY = 4096  # rows; the sparse index keeps (time, row) of every INDEX_EVERY-th row
+INDEX_FILE_NAME = "index.i8"
+LATE_DIR_NAME = "late"
+
+
+def get_tape_dir(directory: str, exchange: str, market: str, day: str) -> str:
+    """e.g. tape/Ftx/BTC-PERP/2021-12-10/"""
+    return os.path.join(directory, exchange, market.replace("/", "_"), day)
+
+
+def get_day(time_us: int) -> str:
+    return datetime.fromtimestamp(time_us // US_PER_SECOND, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+class TapeWriter:
+    """
+    appends the trades to the column files; buffered in memory until flush()
+    each day of a market is kept in time order, for find_row: the buffered rows are sorted at
+    flush(), and the ones within hold_us of the latest of the market are held back for the trades
+    still to come out of order, across midnight too. Rows older than the ones on the tape go to
+    the late tape, in `late/` of the directory, as they come; read it whole with open_tape
+    """
+
+    def __init__(self, directory: str, hold_us: int = 0, ordered: bool = True) -> None:
+        self.directory = directory
+        self.hold_us = hold_us
+        self.ordered = ordered
+        self.late = TapeWriter(os.path.join(directory, LATE_DIR_NAME), ordered=False) \
+            if ordered else None
+        self._tapes: Dict[Tuple[str, str, str], dict] = {}  # (exchange, market, day) => tape
+        self._max_times: Dict[Tuple[str, str], int] = {}  # (exchange, market) => latest time
+
+    def append(self, trade_dict: dict) -> None:
+        """trade_dict: as queued by the exchanges, i.e. price and size in ticks and lots"""
+        time_us = to_epoch_us(trade_dict["time"])
+        market_key = (trade_dict["exchange"], trade_dict["market"])
+        key = (*market_key, get_day(time_us))
+        tape = self._tapes.get(key)
+        if tape is None:
+            tape = self._tapes[key] = self._open_tape(*key)
+
+        if self.ordered and time_us < tape["last_time"]:
+            self.late.append(trade_dict)
+            return
+        self._max_times[market_key] = max(self._max_times.get(market_key, time_us), time_us)
+        buffers = tape["buffers"]
+        buffers["time"].append(time_us)
+        buffers["price"].append(trade_dict["price"])
+        buffers["size"].append(trade_dict["size"])
+        buffers["side"].append(SIDES.index(trade_dict["side"]))
+        buffers["liquidation"].append(trade_dict["liquidation"])
+
+    def flush(self, hold: bool = True) -> None:
+        """
+        hold: keeps the rows within hold_us of the latest of the market in memory; not when
+        stopping. The tape of a day is closed once written whole and past the hold
+        """
+        for key, tape in list(self._tapes.items()):
+            until = self._max_times[key[:2]] - self.hold_us if hold else float("inf")
+            self._flush_tape(tape, until)
+            if not tape["buffers"]["time"] and (not self.ordered or until >= tape["end"]):
+                del self._tapes[key]
+        if self.late:
+            self.late.flush()
+
+    def _open_tape(self, exchange: str, market: str, day: str) -> dict:
+        """
+        opens the day; columns left of different lengths by a crash are cut to the
+        shortest one, and the index to the rows left
+        """
+        path = get_tape_dir(self.directory, exchange, market, day)
+        os.makedirs(path, exist_ok=True)
+        rows = min(
+            os.path.getsize(os.path.join(path, column)) // array(typecode).itemsize
+            if os.path.exists(os.path.join(path, column)) else 0
+            for column, typecode in COLUMNS.items()
+        )
+        for column, typecode in COLUMNS.items():
+            with open(os.path.join(path, column), "ab") as file:
+                file.truncate(rows * array(typecode).itemsize)
+        index_path = os.path.join(path, INDEX_FILE_NAME)
+        if os.path.exists(index_path):  # (time, row) pairs of 16 bytes
+            index_size = ((rows + INDEX_EVERY - 1) // INDEX_EVERY) * 16
+            with open(index_path, "ab") as file:
+                file.truncate(min(index_size, os.path.getsize(index_path)))
+        last_time = float("-inf")
+        if rows:
+            last_time = int(np.fromfile(os.path.join(path, "time"), dtype=DTYPES["time"],
+                                        count=1, offset=(rows - 1) * 8)[0])
+
+        return {
+            "path":      path,
+            "end":       to_epoch_us(datetime.strptime(day, "%Y-%m-%d")) + 86_400 * US_PER_SECOND,
+            "rows":      rows,
+            "last_time": last_time,  # of the last row on the tape
+            "buffers":   {column: array(typecode) for column, typecode in COLUMNS.items()},
+        }
+
+    def _flush_tape(self, tape: dict, until: float) -> None:
+        """writes the buffered rows up to `until` (Unix microsecs), in time order if ordered"""
+        buffers = tape["buffers"]
+        times = buffers["time"]
+        order = sorted(range(len(times)), key=times.__getitem__) if self.ordered \
+            else range(len(times))
+        written = [i for i in order if times[i] <= until]
+        if not written:
+            return
+        held = [i for i in order if times[i] > until]
+
+        for column, buffer in buffers.items():
+            with open(os.path.join(tape["path"], column), "ab") as file:
+                array(buffer.typecode, (buffer[i] for i in written)).tofile(file)
+        if self.ordered:
+            index = array("q")
+            for row, i in enumerate(written, start=tape["rows"]):
+                if row % INDEX_EVERY == 0:
+                    index.extend((times[i], row))
+            if index:
+                with open(os.path.join(tape["path"], INDEX_FILE_NAME), "ab") as file:
+                    index.tofile(file)
+            tape["last_time"] = times[written[-1]]
+        tape["rows"] += len(written)
+        for column, buffer in buffers.items():
+            buffers[column] = array(buffer.typecode, (buffer[i] for i in held))
+
+
+def open_tape(directory: str, exchange: str, market: str, day: str) -> Dict[str, np.ndarray]:
+    """the columns of the day as read-only memory maps, i.e. nothing is read until accessed"""
+    path = get_tape_dir(directory, exchange, market, day)
+    columns = {}
+    for column, dtype in DTYPES.items():
+        file_path = os.path.join(path, column)
+        if not os.path.exists(file_path) or not os.path.getsize(file_path):
+            columns[column] = np.empty(0, dtype=dtype)
+        else:
+            columns[column] = np.memmap(file_path, dtype=dtype, mode="r")
+    rows = min(len(values) for values in columns.values())  # the writer may be appending
+    return {column: values[:rows] for column, values in columns.items()}
+
+
+def find_row(time: np.ndarray, index: np.ndarray, time_us: int) -> int:
+    """
+    the first row at or after time_us; the sparse index narrows the binary search down to a
+    block of INDEX_EVERY rows, so that only a page or two of the time column is touched
+    """
+    block = max(int(np.searchsorted(index[:, 0], time_us, side="left")) - 1, 0)
+    low = int(index[block, 1]) if len(index) else 0
+    high = int(index[block + 1, 1]) if block + 1 < len(index) else len(time)
+    return low + int(np.searchsorted(time[low:high], time_us, side="left"))
+
+
+def read_trades(directory: str, exchange: str, market: str, start: int,
+                end: int) -> Generator[Dict[str, np.ndarray], None, None]:
+    """
+    trades in [start, end), Unix microseconds; the columns of each day as slices of the memory
+    maps, i.e. without copying
+    """
+    market_path = os.path.dirname(get_tape_dir(directory, exchange, market, "day"))
+    days = sorted(os.listdir(market_path)) if os.path.isdir(market_path) else []
+    first_day, last_day = get_day(max(start, 0)), get_day(min(end - 1, now_epoch_us()))
+    for day in days:
+        if not first_day <= day <= last_day:
+            continue
+        path = get_tape_dir(directory, exchange, market, day)
+        columns = open_tape(directory, exchange, market, day)
+        index_path = os.path.join(path, INDEX_FILE_NAME)
+        index = np.fromfile(index_path, dtype="<i8").reshape(-1, 2) \
+            if os.path.exists(index_path) else np.empty((0, 2), dtype="<i8")
+        index = index[index[:, 1] < len(columns["time"])]
+
+        low = find_row(columns["time"], index, start)
+        high = find_row(columns["time"], index, end)
+        if high > low:
+            yield {column: values[low:high] for column, values in columns.items()}
@@ -1,11 +1,34 @@
-from datetime import datetime
+import json
+import sqlite3
+
+from datetime import datetime, timedelta, timezone
+from queue import Queue
+
+import numpy as np
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from requests import Response
 
 from main import get_turned_candle_periods, get_current_candle_periods
+from main import get_period_start, parse_resolutions
+import main
+from candle_service import CandleCache
+from db import Candle, OpenInterest, Trade, to_epoch_us, to_units, from_units, US_PER_SECOND
+from retention import archive_trades, find_cutoff_id, get_archive_path, read_archive
+from ftx.rest.client import FtxClient
+from ftx.websocket.client import FtxWebsocketClient, decode_trades
+from tape import TapeWriter, open_tape, read_trades, INDEX_EVERY, LATE_DIR_NAME
+from batch_candles import align_range, compute_candles
+import exchanges
+import export
+import migrate
+from storage import MemoryBackend, SqliteBackend, StorageBackend
 
 
 def test_get_turned_candle_periods():
     time = datetime(2021, 12, 10, 11, 46, 3)
-    periods = list(get_turned_candle_periods(time))
+    periods = list(get_turned_candle_periods(time, [60, 3_600, 86_400]))
     assert len(periods) == 1
     period = periods[0]
     assert period["resolution"] == 60
@@ -15,7 +38,7 @@ def test_get_turned_candle_periods():
 
 def test_get_current_candle_periods():
     time = datetime(2021, 12, 10, 11, 46, 3)
-    periods = list(get_current_candle_periods(time))
+    periods = list(get_current_candle_periods(time, [60, 3_600, 86_400]))
     assert len(periods) == 3
     for period in periods:
         if period["resolution"] == 60:
@@ -33,3 +56,436 @@ def test_get_current_candle_periods():
             assert period["start_time"].minute == 0
             assert period["start_time"].hour == 0
             assert period["start_time"].day == 10
+
+
+def test_get_turned_candle_periods_at_the_turn_of_the_day():
+    time = datetime(2021, 12, 10, 0, 0, 5)
+    periods = list(get_turned_candle_periods(time, [15, 60, 300, 900, 3_600, 14_400, 86_400]))
+    assert [period["resolution"] for period in periods] == [
+        15, 60, 300, 900, 3_600, 14_400, 86_400]
+    for period in periods:
+        assert period["start_time"] == datetime(2021, 12, 10) - timedelta(
+            seconds=period["resolution"])
+
+
+def test_get_period_start():
+    time = datetime(2021, 12, 10, 11, 46, 37)
+    assert get_period_start(time, 15) == datetime(2021, 12, 10, 11, 46, 30)
+    assert get_period_start(time, 300) == datetime(2021, 12, 10, 11, 45)
+    assert get_period_start(time, 900) == datetime(2021, 12, 10, 11, 45)
+    assert get_period_start(time, 14_400) == datetime(2021, 12, 10, 8)
+    assert get_period_start(time, 86_400) == datetime(2021, 12, 10)
+    assert get_period_start(time, 7 * 86_400) == datetime(2021, 12, 9)  # epoch was a Thursday
+
+
+def test_parse_resolutions():
+    assert parse_resolutions("3600, 60,86400,15") == [15, 60, 3_600, 86_400]
+    with pytest.raises(ValueError):
+        parse_resolutions("60,90")
+
+
+def make_candle(start_time, close):
+    return Candle(exchange_name="Ftx", market="BTC-PERP", resolution=60, start_time=start_time,
+                  open=1, close=close, high=close, low=1, volume=1)
+
+
+def test_open_interest(monkeypatch):
+    queue = Queue()
+    ftx = exchanges.Ftx(["BTC-PERP", "BTC/USD"], queue)
+    monkeypatch.setattr(ftx.rest, "list_futures", lambda: [
+        {"name": "BTC-PERP", "openInterest": 12.5, "mark": 48123.5, "index": 48120.0},
+        {"name": "ETH-PERP", "openInterest": 99.0, "mark": 4000.0, "index": 4001.0},
+    ])
+    close_time = datetime(2021, 12, 10, 11, 46, tzinfo=timezone.utc)
+    ftx.get_open_interest(close_time)  # BTC/USD is not a future, ETH-PERP not subscribed to
+    item = queue.get_nowait()
+    assert queue.empty()
+    assert item["futures"] == [{"market": "BTC-PERP", "open_interest": 12.5,
+                                "mark_price": 48123.5, "index_price": 48120.0}]
+
+    monkeypatch.setattr(main, "session", MemoryBackend().writer_session())
+    main.save_open_interest(item)
+    (row,) = main.session.query(OpenInterest).all()
+    assert (row.exchange_name, row.market, row.time) == ("Ftx", "BTC-PERP", to_epoch_us(close_time))
+    assert row.open_interest == 12.5
+
+
+def test_candle_cache_ring_buffer():
+    cache = CandleCache(size=3)
+    for start_time in [0, 60, 120, 180]:
+        cache.put(make_candle(start_time, close=1), closed=True)
+    cache.put(make_candle(240, close=1))
+    cache.put(make_candle(240, close=2))  # open candle updated in place
+
+    candles = cache.get_candles("Ftx", "BTC-PERP", 60, start=120)
+    assert [c["start_time"] for c in candles] == [120, 180, 240]
+    assert candles[-1]["close"] == 2 and not candles[-1]["closed"]
+    assert [c["start_time"] for c in cache.get_candles("Ftx", "BTC-PERP", 60, limit=2)] == [
+        180, 240]
+    # neither start nor limit: the buffer, not the whole history from the db
+    assert len(cache.get_candles("Ftx", "BTC-PERP", 60)) == 3
+
+
+def test_candle_cache_notifies_closed_candles():
+    cache = CandleCache(size=3)
+    subscriber = cache.subscribe(market="BTC-PERP", resolution=60)
+    other = cache.subscribe(market="ETH-PERP")
+    cache.put(make_candle(0, close=1))
+    assert subscriber.empty()
+    cache.put(make_candle(0, close=2), closed=True)
+    assert subscriber.get_nowait()["close"] == 2
+    cache.put(make_candle(0, close=3))  # a late update does not reopen the candle
+    assert cache.get_candles("Ftx", "BTC-PERP", 60, start=0)[0]["closed"]  # not from the db
+    assert other.empty()
+
+
+def test_archive_trades(tmp_path):
+    session = MemoryBackend().writer_session()
+    day, one_day = to_epoch_us(datetime(2021, 12, 10)), 86_400 * US_PER_SECOND
+    for time in [day + 1, day + 2, day + one_day + 1, day + 3 * one_day]:
+        session.add(Trade(exchange_name="Ftx", market="BTC/USD", price=15, side="sell", size=2,
+                          time=time, liquidation=False))
+    session.commit()
+
+    before = day + 2 * one_day
+    assert find_cutoff_id(session, before) == 4 and find_cutoff_id(session, day) == 1
+    assert archive_trades(session, before=before, batch_size=2, directory=tmp_path) == 2
+    assert archive_trades(session, before=before, batch_size=2, directory=tmp_path) == 1
+    assert session.query(Trade).count() == 1
+
+    trades = list(read_archive(get_archive_path(tmp_path, "Ftx", "BTC/USD", "2021-12-10")))
+    assert [trade["time"] for trade in trades] == [day + 1, day + 2]
+    assert trades[0]["side"] == "sell" and trades[0]["price"] == 15
+    assert len(list(read_archive(get_archive_path(tmp_path, "Ftx", "BTC/USD", "2021-12-11")))) == 1
+    with pytest.raises(ValueError):  # of an older version
+        list(read_archive(tmp_path / "Ftx" / "BTC_USD" / "2021-12-10.trades.gz"))
+
+
+def test_to_epoch_us():
+    time = datetime.strptime("2021-12-09T13:49:39.407690+00:00", "%Y-%m-%dT%H:%M:%S.%f%z")
+    assert to_epoch_us(time) == 1_639_057_779_407_690
+    assert to_epoch_us(datetime(1970, 1, 1, 0, 0, 1)) == US_PER_SECOND  # naive is UTC
+    assert to_epoch_us(datetime(1970, 1, 1, 1, tzinfo=timezone(timedelta(hours=1)))) == 0
+
+
+def test_migrate_twice(tmp_path, monkeypatch):
+    path = str(tmp_path / "v1.sqlite3")
+    with sqlite3.connect(path) as connection:  # schema version 1: float times, prices, sizes
+        connection.executescript("""
+            CREATE TABLE exchange (name VARCHAR PRIMARY KEY);
+            CREATE TABLE market (id INTEGER PRIMARY KEY, exchange_name VARCHAR, name VARCHAR,
+                price_increment FLOAT, size_increment FLOAT);
+            CREATE TABLE trade (id INTEGER PRIMARY KEY, exchange_name VARCHAR, market VARCHAR,
+                price FLOAT, side VARCHAR, size FLOAT, time FLOAT, liquidation BOOLEAN);
+            CREATE TABLE candle (id INTEGER PRIMARY KEY, exchange_name VARCHAR, market VARCHAR,
+                resolution INTEGER, start_time FLOAT, open FLOAT, close FLOAT, high FLOAT,
+                low FLOAT, volume FLOAT);
+            INSERT INTO market VALUES (1, 'Ftx', 'BTC-PERP', 0.5, 0.001);
+            INSERT INTO trade VALUES (1, 'Ftx', 'BTC-PERP', 48123.5, 'buy', 0.01,
+                1639057779.40769, 0);
+            INSERT INTO candle VALUES (1, 'Ftx', 'BTC-PERP', 60, 1639057740.0, 48123.5, 48123.5,
+                48123.5, 48123.5, 481.235);
+        """)
+    monkeypatch.setattr(migrate, "storage", SqliteBackend(path))
+
+    rebuild_table = migrate.rebuild_table
+
+    def interrupted(table_name, *args, **kwargs):
+        if table_name == "candle":
+            raise KeyboardInterrupt()  # the trades are converted already
+        rebuild_table(table_name, *args, **kwargs)
+
+    monkeypatch.setattr(migrate, "rebuild_table", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        migrate.migrate()
+    monkeypatch.setattr(migrate, "rebuild_table", rebuild_table)
+    migrate.migrate()
+    migrate.migrate()  # up to date, nothing to do
+
+    with sqlite3.connect(path) as connection:
+        assert connection.execute("SELECT time, price, size FROM trade").fetchall() == [
+            (1_639_057_779_407_690, 96247, 10)]
+        assert connection.execute("SELECT start_time, volume FROM candle").fetchall() == [
+            (1_639_057_740_000_000, 962470)]
+        assert connection.execute("PRAGMA user_version").fetchone() == (3,)
+        assert connection.execute("PRAGMA auto_vacuum").fetchone() == (2,)  # incremental
+
+
+def test_units():
+    assert to_units(48_123.5, 0.5) == 96_247
+    assert to_units(0.0123, 0.0001) == 123  # 0.0123 / 0.0001 == 122.99999999999999
+    assert from_units(123, 0.0001) == 0.0123  # 123 * 0.0001 == 0.012300000000000002
+    assert from_units(96_247, 0.5) == 48_123.5
+    assert from_units(7, 10.0) == 70
+
+
+def make_response(status_code, body=b'{"success": true, "result": []}', headers=None):
+    response = Response()
+    response.status_code, response._content = status_code, body
+    response.headers.update(headers or {})
+    return response
+
+
+def test_rest_client_retries(monkeypatch):
+    monkeypatch.setenv("FTX_API_KEY", "key")
+    monkeypatch.setenv("FTX_API_SECRET", "secret")
+    client = FtxClient(backoff=0)
+    sleeps = []
+    monkeypatch.setattr("ftx.rest.client.time.sleep", sleeps.append)
+
+    sent = []
+    responses = [make_response(429, headers={"Retry-After": "2"}), make_response(503),
+                 make_response(200)]
+    monkeypatch.setattr(client._session, "send",
+                        lambda prepared, timeout: sent.append(prepared) or responses.pop(0))
+    assert client.list_markets() == []
+    assert len(sent) == 3 and sleeps[0] == 2
+    assert sent[0].headers["FTX-SIGN"]
+    assert client.get_latencies()["GET markets"]["count"] == 3
+
+    responses = [make_response(503, body=b'{"success": false, "error": "busy"}')]
+    with pytest.raises(Exception, match="busy"):  # an order is not placed twice
+        client.place_order("BTC-PERP", "buy", price=1, size=1)
+
+
+def test_tape(tmp_path):
+    writer = TapeWriter(tmp_path)
+    start = datetime(2021, 12, 10, 23, 0, tzinfo=timezone.utc)
+    for i in range(3 * INDEX_EVERY):  # over 2 days, 1 sec apart
+        writer.append({"exchange": "Ftx", "market": "BTC-PERP", "price": i, "size": 2 * i,
+                       "side": ["buy", "sell"][i % 2], "liquidation": False,
+                       "time": start + timedelta(seconds=i)})
+    writer.flush()
+
+    first = to_epoch_us(start)
+    days = list(read_trades(tmp_path, "Ftx", "BTC-PERP", first + 100 * US_PER_SECOND,
+                            first + 5_000 * US_PER_SECOND))
+    assert len(days) == 2  # 23:00 + 3_600 secs is the next day
+    assert list(days[0]["price"][:2]) == [100, 101] and list(days[0]["side"][:2]) == [0, 1]
+    assert days[1]["price"][-1] == 4_999
+    assert sum(len(day["time"]) for day in days) == 4_900
+
+
+def test_tape_out_of_order(tmp_path):
+    writer = TapeWriter(tmp_path, hold_us=2 * US_PER_SECOND)
+    start = datetime(2021, 12, 10, 10, 0, tzinfo=timezone.utc)
+
+    def append(*seconds):
+        for second in seconds:
+            writer.append({"exchange": "Ftx", "market": "BTC-PERP", "price": second, "size": 1,
+                           "side": "buy", "liquidation": False,
+                           "time": start + timedelta(seconds=second)})
+
+    append(10, 12, 11)
+    writer.flush()  # 11 and 12 are held, a trade may still come before them
+    append(9, 20)  # 9: older than 10, on the tape already
+    writer.flush()
+    writer.flush(hold=False)
+
+    (day,) = read_trades(tmp_path, "Ftx", "BTC-PERP", 0, to_epoch_us(start) + 10**9)
+    assert list(day["price"]) == [10, 11, 12, 20]
+    late = open_tape(tmp_path / LATE_DIR_NAME, "Ftx", "BTC-PERP", "2021-12-10")
+    assert list(late["price"]) == [9]
+
+
+def test_tape_out_of_order_around_midnight(tmp_path):
+    writer = TapeWriter(tmp_path, hold_us=2 * US_PER_SECOND)
+    midnight = datetime(2021, 12, 11, tzinfo=timezone.utc)
+    for second in [-2, 1, -1, 0, 2, 5]:  # -1: a trade of the day before, come after midnight
+        writer.append({"exchange": "Ftx", "market": "BTC-PERP", "price": second, "size": 1,
+                       "side": "buy", "liquidation": False,
+                       "time": midnight + timedelta(seconds=second)})
+        writer.flush()
+    writer.flush(hold=False)
+
+    days = read_trades(tmp_path, "Ftx", "BTC-PERP", 0, to_epoch_us(midnight) + 10**9)
+    assert [list(day["price"]) for day in days] == [[-2, -1], [0, 1, 2, 5]]
+    assert not (tmp_path / LATE_DIR_NAME).exists()
+
+
+def test_compute_candles():
+    rng = np.random.default_rng(0)
+    time = np.sort(rng.integers(0, 3_600 * US_PER_SECOND, 10_000))
+    price, size = rng.integers(1, 100, len(time)), rng.integers(1, 10, len(time))
+    candles = compute_candles({"time": time, "price": price, "size": size}, 300,
+                              0, 3_600 * US_PER_SECOND)
+
+    assert len(candles["start_time"]) == 12
+    for i, start_time in enumerate(candles["start_time"]):
+        in_period = (time >= start_time) & (time < start_time + 300 * US_PER_SECOND)
+        assert candles["open"][i] == price[in_period][0]
+        assert candles["close"][i] == price[in_period][-1]
+        assert candles["high"][i] == price[in_period].max()
+        assert candles["low"][i] == price[in_period].min()
+        assert candles["volume"][i] == (price[in_period] * size[in_period]).sum()
+
+
+def test_align_range():
+    start, end = to_epoch_us(datetime(2021, 12, 1)), to_epoch_us(datetime(2022, 1, 1))
+    assert align_range(3_600, start, end) == (start, end)
+    week = 7 * 86_400  # periods from the epoch, a Thursday, and not from the dates
+    aligned_start, aligned_end = align_range(week, start, end)
+    assert aligned_start == to_epoch_us(datetime(2021, 12, 2))
+    assert aligned_end == to_epoch_us(datetime(2021, 12, 30))
+
+
+def test_export_csv(tmp_path, monkeypatch):
+    backend = MemoryBackend()
+    monkeypatch.setattr(export, "storage", backend)
+    session = backend.writer_session()
+    for time in range(10):
+        session.add(Trade(exchange_name="Ftx", market="BTC-PERP", price=time, side="buy", size=1,
+                          time=time, liquidation=False))
+    session.commit()
+
+    assert export.export("trades", tmp_path / "trades.csv", "csv", start=2, end=8) == 6
+    with open(tmp_path / "trades.csv") as file:
+        lines = file.read().splitlines()
+    assert lines[0] == "id,exchange_name,market,price,side,size,time,liquidation"
+    assert lines[1] == "3,Ftx,BTC-PERP,2,buy,1,2,False" and len(lines) == 7
+    assert [len(rows) for rows in export.stream_rows(Trade, chunk_size=4)] == [4, 4, 2]
+
+
+def test_sqlite_backend(tmp_path):
+    backend = SqliteBackend(str(tmp_path / "ftx.sqlite3"))
+    backend.reset()
+    writer, reader = backend.writer_session(), backend.reader_session()
+    writer.add(Trade(exchange_name="Ftx", market="BTC-PERP", price=1, side="buy", size=1, time=1,
+                     liquidation=False))
+    writer.flush()  # a write transaction is open, the reader is not blocked
+    assert reader.query(Trade).count() == 0
+    writer.commit()
+    assert reader.query(Trade).count() == 1
+    assert reader.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+    with pytest.raises(OperationalError):  # read-only
+        reader.execute(text("DELETE FROM trade"))
+    with pytest.raises(TypeError):  # abstract
+        StorageBackend()
+
+
+@pytest.fixture
+def candle_cache(monkeypatch):
+    """the candle state of main.py, fresh and on a db in memory; returns its cache"""
+    backend = MemoryBackend()
+    cache = CandleCache(size=3, session_factory=backend.reader_session)
+    monkeypatch.setattr(main, "session", backend.writer_session())
+    monkeypatch.setattr(main, "candle_cache", cache)
+    monkeypatch.setattr(main, "CANDLE_RESOLUTIONS", [60, 3600])
+    monkeypatch.setattr(main, "ALLOWED_LATENESS_US", 2 * US_PER_SECOND)
+    for state in ["open_candles", "trade_times", "rolled_up_until", "watermarks",
+                  "late_trade_counts", "seeded_volumes"]:
+        monkeypatch.setattr(main, state, {})
+    return cache
+
+
+def trade(seconds, price, size=1):
+    """feeds a trade of BTC-PERP at 2021-12-10 10:00 + seconds to main.py"""
+    main.save_trade_and_update_candle({
+        "exchange": "Ftx", "market": "BTC-PERP", "liquidation": False, "price": price,
+        "side": "buy", "size": size,
+        "time": datetime(2021, 12, 10, 10, 0) + timedelta(seconds=seconds)})
+
+
+def test_watermark_finalizes_candles_and_counts_late_trades(candle_cache):
+    cache, hour_start = candle_cache, to_epoch_us(datetime(2021, 12, 10, 10, 0))
+    trade(30, 1)
+    trade(61, 2)  # next minute, but the first one may still get trades
+    trade(59.5, 3)  # out of order, in time
+    assert not cache.get_candles("Ftx", "BTC-PERP", 60, hour_start)[0]["closed"]
+    trade(63, 4)  # the watermark passes the end of the first minute
+    first = cache.get_candles("Ftx", "BTC-PERP", 60, hour_start)[0]
+    assert first["closed"] and first["close"] == 3
+    trade(59.9, 5)  # late
+    assert cache.get_candles("Ftx", "BTC-PERP", 60, hour_start)[0]["close"] == 3
+    assert cache.get_candles("Ftx", "BTC-PERP", 3600, hour_start)[0]["volume"] == 4
+    assert cache.get_watermarks() == [{"exchange": "Ftx", "market": "BTC-PERP",
+                                       "watermark": hour_start + 61 * US_PER_SECOND,
+                                       "late_trades": 1}]
+
+
+def test_late_trade_is_not_rolled_up_twice(candle_cache, monkeypatch):
+    monkeypatch.setattr(main, "CANDLE_RESOLUTIONS", [60, 300, 3600])
+    trade(30, 1)
+    trade(70, 1)  # the first minute is final
+    trade(40, 1)  # late
+    trade(3700, 1)  # the first 5 minutes are final, and rolled up into the hour
+    hour_start = to_epoch_us(datetime(2021, 12, 10, 10, 0))
+    assert candle_cache.get_candles("Ftx", "BTC-PERP", 3600, hour_start)[0]["volume"] == 2
+    assert main.late_trade_counts[("Ftx", "BTC-PERP")] == 1
+
+
+def test_trade_of_a_final_period_without_trades_is_late(candle_cache, monkeypatch):
+    monkeypatch.setattr(main, "CANDLE_RESOLUTIONS", [60, 3600, 86400])
+    trade(3510, 1)  # 10:58:30
+    trade(3605, 1)  # 11:00:05, the 10:00 hour is final
+    trade(3570, 1)  # 10:59:30, no trades in that minute so far, but final as well
+    assert main.late_trade_counts == {("Ftx", "BTC-PERP"): 1}
+    trade(3665, 1)  # 11:01:05
+    day_start = to_epoch_us(datetime(2021, 12, 10))
+    hours = candle_cache.get_candles("Ftx", "BTC-PERP", 3600, day_start)
+    assert [hour["volume"] for hour in hours] == [1, 1]  # 11:01 is not rolled up yet
+    # the 10:00 hour only; the 11:00 one is not over yet
+    assert candle_cache.get_candles("Ftx", "BTC-PERP", 86400, day_start)[0]["volume"] == 1
+
+
+def test_candles_of_the_first_pull_are_not_rolled_up_twice(candle_cache, monkeypatch):
+    hour_start = to_epoch_us(datetime(2021, 12, 10, 10, 0))
+    monkeypatch.setattr(main, "now_epoch_us", lambda: hour_start + 30 * US_PER_SECOND)
+    for resolution, volume in [(60, 10), (3600, 100)]:  # the hour contains the minute already
+        main.save_candle_received_and_compare_with_calculated({
+            "exchange": "Ftx", "market": "BTC-PERP", "time": hour_start,
+            "resolution": resolution, "open": 5, "close": 5, "high": 5, "low": 5,
+            "volume": volume})
+    trade(40, 5)
+    trade(63, 5)  # the first minute is final
+    assert candle_cache.get_candles("Ftx", "BTC-PERP", 60, hour_start)[0]["volume"] == 15
+    assert candle_cache.get_candles("Ftx", "BTC-PERP", 3600, hour_start)[0]["volume"] == 105
+
+
+def test_out_of_order_trades_in_a_candle(candle_cache):
+    for seconds, price in [(10, 100), (30, 300), (20, 200), (5, 50)]:
+        trade(seconds, price)
+    hour_start = to_epoch_us(datetime(2021, 12, 10, 10, 0))
+    candle = candle_cache.get_candles("Ftx", "BTC-PERP", 60, hour_start)[0]
+    assert (candle["open"], candle["close"], candle["high"], candle["low"]) == (50, 300, 300, 50)
+
+
+def test_websocket_dispatch():
+    trades = ('{"channel": "trades", "market": "BTC-PERP", "type": "update", "data": [{"id": 1,'
+              ' "price": 48123.5, "size": 0.01, "side": "buy", "liquidation": false,'
+              ' "time": "2021-12-09T13:49:39.407690+00:00"}]}')
+    ticker = '{"channel": "ticker", "market": "BTC-PERP", "type": "update", "data": {"bid": 1.0}}'
+    client = FtxWebsocketClient(compact_trades=True)
+    client._handlers.pop("ticker")  # not consumed
+    client._on_message(None, trades)
+    client._on_message(None, ticker)
+    client._on_message(None, '{"type": "subscribed", "channel": "trades", "market": "BTC-PERP"}')
+
+    record = client._trades["BTC-PERP"][0][0]
+    assert (record.price, record.side, record.liquidation) == (48123.5, "buy", False)
+    assert client._tickers == {}
+    costs = client.get_decode_costs()
+    assert costs["trades"]["count"] == 1 and costs["skipped"]["count"] == 1
+    with pytest.raises(Exception):
+        client._on_message(None, '{"type": "error", "code": 400, "msg": "Not logged in"}')
+
+    client = FtxWebsocketClient()  # into dicts
+    client._on_message(None, trades)
+    assert client._trades["BTC-PERP"][0][0]["price"] == 48123.5
+
+
+def test_ingest_trades_from_records_or_dicts():
+    trades = ('{"channel": "trades", "market": "BTC-PERP", "type": "update", "data": [{"id": 1,'
+              ' "price": 48123.5, "size": 0.01, "side": "buy", "liquidation": false,'
+              ' "time": "2021-12-09T13:49:39.407690+00:00"}]}')
+    queue = Queue()
+    client = exchanges.FtxWebsocketClientExtended(queue, "Ftx")
+    client.increments = {"BTC-PERP": (0.5, 0.001)}
+    client._handle_trade_records(decode_trades(trades))
+    client._handle_trades_message(json.loads(trades))
+
+    from_records, from_dicts = queue.get(), queue.get()
+    assert from_records.pop("number") == 1 and from_dicts.pop("number") == 2
+    assert from_records == from_dicts
+    assert (from_dicts["price"], from_dicts["size"]) == (96_247, 10)
+    assert to_epoch_us(from_dicts["time"]) == 1_639_057_779_407_690